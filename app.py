@@ -1,31 +1,122 @@
 # DISCLAIMER: This application is NOT production-ready and shouldn't be treated as such.
 
-# It is not uWSGI-ready, meaning it will only run as a single worker application.
-# Either configure uWSGI properly to only spawn a single worker, or use the embedded werkzeug development server
-
-# Failing to configure your WSGI server properly may cause a de-synchronization with artworks, resulting in
-# potential data loss or corruption if refresh or delete is used, as artworks are only loaded on application start.
+# It can run as several worker processes (uWSGI, gunicorn...): the store, the config and temp.json are synced from
+# their files before every request, and refresh/delete/duplicate scans are locked across processes (see shared.py).
+# Every worker must share the same working directory and temp_path, on a local filesystem supporting POSIX locks.
 
 # The provided app_key can be modified, and only allows Flask's flash() method to work properly.
 
 from flask import Flask, redirect, url_for, request, render_template, send_file, Response, make_response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from contextlib import closing
 import threading
-from random import choice
+import time
+from random import randrange
 from math import ceil
-from json import dumps
+from json import dumps, loads
+from pathlib import Path
+from urllib.parse import urlencode
+from datetime import datetime
 
 import utils
 from utils import conf, artworks, temp, flash
 
-from files import make_zip, make_pdf
+import files
+from files import make_zip, make_pdf, stream_zip
+import renditions
 
 from objects import Artwork
-import pixiv
+import search
+import duplicates
+import jobs
+import scrub
+import metrics
+import objects.artwork
+import storage
 
 app = Flask(__name__)
+app.jinja_env.globals["rendition_widths"] = renditions.WIDTHS
 app.secret_key = conf["app_key"]
 
 
+@app.before_request
+def sync_shared_state():
+    # Other workers may have changed the config, the sync state or the artworks since the last request
+    conf.sync()
+    temp.sync()
+    artworks.sync()
+
+
+@app.before_request
+def start_timer():
+    request.environ["pbe.start"] = time.perf_counter()
+
+
+@app.after_request
+def record_request(resp):
+    # Recorded once the body was sent, downloads are streamed after the view returns. Files are handed to the server
+    # as they are (the response is never closed), their time is the time to the first byte
+    start = request.environ.get("pbe.start")
+    if start is not None:
+        endpoint = request.endpoint or "none"
+        if resp.direct_passthrough:
+            metrics.requests.observe(time.perf_counter() - start, endpoint)
+        else:
+            resp.call_on_close(lambda: metrics.requests.observe(time.perf_counter() - start, endpoint))
+        metrics.responses.inc(1, endpoint, resp.status_code)
+    return resp
+
+
+def _store_size():
+    path = getattr(artworks, "path", None)
+    return {("artworks",): artworks.count(), ("sfw",): artworks.count(sfw=True),
+            ("bytes",): path.stat().st_size if path is not None and path.is_file() else 0}
+
+
+def _caches():
+    # (cache,) -> LRU/disk cache, their hit ratio is hits / (hits + misses)
+    caches = {("artworks",): objects.artwork.cache, ("exports",): files.exports, ("flattened",): files.flattened,
+              ("renditions",): renditions.cache}
+    if storage.backend.cache is not None:
+        caches[("remote",)] = storage.backend.cache
+    return caches
+
+
+metrics.Collected("pbe_store", "Stored artworks (all and SFW) and size of the metadata store", ("value",), _store_size)
+metrics.Collected("pbe_cache_hits_total", "Cache lookups that found the entry", ("cache",),
+                  lambda: {k: c.hits for k, c in _caches().items()}, type="counter")
+metrics.Collected("pbe_cache_misses_total", "Cache lookups that didn't find the entry", ("cache",),
+                  lambda: {k: c.misses for k, c in _caches().items()}, type="counter")
+metrics.Collected("pbe_cache_size", "Entries in the artwork cache, bytes in the disk caches", ("cache",),
+                  lambda: {**{k: c.size for k, c in _caches().items()}, ("artworks",): len(objects.artwork.cache.data)})
+
+
+def _start_locked(lock, target, *args):
+    # Runs target in a background thread holding a lock shared by every worker. Returns False if it's already held
+    if not lock.acquire():
+        return False
+
+    def run():
+        try:
+            target(*args)
+        finally:
+            lock.release()
+    threading.Thread(target=run).start()
+    return True
+
+
+def _ipp(ipp=None):
+    # Images per page, from the route or the config. 0 shows every artwork, invalid settings fall back to 50
+    try:
+        ipp = int(ipp or conf["display"]["home"]["ipp"])
+    except ValueError:
+        ipp = -1
+    if ipp < 0:
+        flash("<b>Invalid display settings.</b> The images-per-page setting was set to <u>50</u>.", "warning")
+        ipp = 50
+    return ipp
+
+
 @app.route("/")
 @app.route("/p/<page>")
 @app.route("/p/<page>/<image>/<ipp>/<order>")
@@ -41,48 +132,141 @@ def home(page=None, image=None, ipp=None, order=None):
         flash("<b>Invalid page.</b> Falling back to page <u>1</u>.", "warning")
         page = 1
     image = image or conf["display"]["home"]["image"]
-    try:
-        ipp = int(ipp or conf["display"]["home"]["ipp"])
-    except ValueError:
-        ipp = -1
+    ipp = _ipp(ipp)
     order = order or conf["display"]["home"]["order"]
 
     # Check that display settings are supported, reset them in case they're not
-    if image not in ("original", "large", "medium", "square_medium", "none"):
+    if image not in ("original", "large", "medium", "square_medium", "none") and renditions.width(image) is None:
         flash("<b>Invalid display settings.</b> The image setting was set to <u>original</u>.", "warning")
         image = "original"
-    if ipp < 0:
-        flash("<b>Invalid display settings.</b> The images-per-page setting was set to <u>50</u>.", "warning")
-        ipp = 50
     if order not in ("default", "artwork"):
         flash("<b>Invalid display settings.</b> The order setting was set to <u>default</u>.", "warning")
         order = "default"
 
     # Get artworks and do some pagination
     if _show_nsfw:
-        aws = Artwork.all(limit=ipp, offset=ipp * (page - 1))
-        aw_count = len(artworks)
+        aws = Artwork.all(limit=ipp, offset=ipp * (page - 1), order=order)
+        aw_count = artworks.count()
     else:
-        aws = Artwork.all_filtered(limit=ipp, offset=ipp * (page - 1))
-        aw_count = len([a for a in artworks.values() if a["x_restrict"] <= 0])
+        aws = Artwork.all_filtered(limit=ipp, offset=ipp * (page - 1), order=order)
+        aw_count = artworks.count(sfw=True)
     if ipp > 0:
         pages = ceil(aw_count / ipp)
         pagination = utils.gen_paginate_data(page, pages, f"/p/{{}}/{image}/{ipp}/{order}" if _full_route else "/p/{}",
                                              margin=5)
     else:  # Remove pagination in case ipp = max, leaving pagination would raise a DivisionByZeroError
         pagination = []
-    if order == "artwork":
-        aws.sort(key=lambda x: x.post_date, reverse=True)
     return render_template("home.html", artworks=aws,
                            display_config=conf["display"]["home"], image=image,
                            pagination=pagination,
                            ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
 
 
+def _search_url(args, **changes):
+    # Search URL with the current arguments, changed by the given ones (None removes an argument)
+    return "/search?" + urlencode({k: v for k, v in {**args, **changes}.items() if v not in (None, "")})
+
+
+@app.route("/search")
+def search_artworks():
+    _show_nsfw = utils.get_nsfw("home")
+    _nsfw_pref, _nsfw_user = utils.get_nsfw_state("home")
+    args = {k: v for k, v in request.args.items() if k in ("q", "tag", "user", "x", "order") and v}
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+        user = int(args["user"]) if "user" in args else None
+        x_restrict = int(args["x"]) if "x" in args else None
+    except ValueError:
+        flash("<b>Invalid search.</b> The page, user and x arguments must be numbers.", "warning")
+        return redirect(url_for("search_artworks"))
+    image = conf["display"]["home"]["image"]
+    ipp = _ipp()
+
+    # Only the ids of the requested page are returned by the index, along with the total count and the facets
+    filters = {"query": args.get("q", ""), "tag": args.get("tag"), "user": user, "x_restrict": x_restrict,
+               "sfw": not _show_nsfw}
+    ids, total = search.index.search(**filters, limit=ipp, offset=ipp * (page - 1),
+                                     order=args.get("order", "relevance"))
+    facets = search.index.facets(**filters, size=conf.get("search", {}).get("facets", 20))
+    # The index can be ahead of the store of this worker while another one is refreshing
+    aws = [aw for aw in map(Artwork.from_id, ids) if aw is not None]
+    if ipp > 0:
+        base_path = _search_url(args) + ("&" if args else "") + "page={}"
+        pagination = utils.gen_paginate_data(page, ceil(total / ipp), base_path, margin=5)
+    else:
+        pagination = []
+    return render_template("home.html", artworks=aws,
+                           display_config=conf["display"]["home"], image=image,
+                           pagination=pagination, search=args, total=total, facets=facets,
+                           search_url=lambda **kw: _search_url(args, **kw),
+                           ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
+
+
+def _group_page(kind, key, title):
+    # Page of the artworks with a tag or by a user, read from the store index
+    _show_nsfw = utils.get_nsfw("home")
+    _nsfw_pref, _nsfw_user = utils.get_nsfw_state("home")
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        flash("<b>Invalid page.</b> Falling back to page <u>1</u>.", "warning")
+        page = 1
+    image = conf["display"]["home"]["image"]
+    ipp = _ipp()
+    ids = artworks.group_ids(kind, key, limit=ipp, offset=ipp * (page - 1), sfw=not _show_nsfw)
+    total = artworks.group_count(kind, key, sfw=not _show_nsfw)
+    if total == 0:
+        flash("<b>Not found.</b> There are no artworks to show.", "danger")
+    if ipp > 0:
+        # The quoted URL of the page, with its braces escaped as it is used as a format string
+        path = url_for(request.endpoint, **request.view_args).replace("{", "{{").replace("}", "}}")
+        pagination = utils.gen_paginate_data(page, ceil(total / ipp), path + "?page={}", margin=5)
+    else:
+        pagination = []
+    return render_template("home.html", artworks=[Artwork.from_id(a) for a in ids],
+                           display_config=conf["display"]["home"], image=image,
+                           pagination=pagination, heading=title, total=total,
+                           ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
+
+
+@app.route("/t/<path:tag>")
+def tag_artworks(tag):
+    return _group_page("tag", tag, tag)
+
+
+@app.route("/u/<user>")
+def user_artworks(user):
+    try:
+        user = int(user)
+    except ValueError:
+        flash("<b>Not found.</b> User ids are numbers.", "danger")
+        return redirect(url_for("home"))
+    ids = artworks.group_ids("user", user, limit=1)
+    return _group_page("user", user, Artwork.from_id(ids[0]).user.name if ids else str(user))
+
+
+@app.route("/top")
+def top():
+    # Tags and artists with the most artworks. Rankings are kept by the store index until artworks change
+    _show_nsfw = utils.get_nsfw("home")
+    _nsfw_pref, _nsfw_user = utils.get_nsfw_state("home")
+    size = conf["display"].get("top", 100)
+    users = []
+    for uid, count in artworks.top("user", size, sfw=not _show_nsfw):
+        latest = Artwork.from_id(artworks.group_ids("user", uid, limit=1)[0])
+        users.append((latest.user, count))
+    return render_template("top.html", tags=artworks.top("tag", size, sfw=not _show_nsfw), users=users,
+                           ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
+
+
 @app.route("/random")
 def random():
-    r = choice(list(artworks.keys()))
-    return redirect(url_for("artwork_show", artwork=r))
+    # One entry at a random offset of the bookmark order kept by the index, rather than a copy of every id
+    count = artworks.count()
+    r = artworks.ids(limit=1, offset=randrange(count)) if count else []
+    if not r:  # empty, or emptied since counted
+        return redirect(url_for("home"))
+    return redirect(url_for("artwork_show", artwork=r[0]))
 
 
 @app.route("/refresh")
@@ -91,46 +275,129 @@ def refresh():
     if conf["read_only"]:
         flash("<b>Application is read-only.</b> Cannot refresh artworks.", "danger")
         return redirect(url_for("home"))
-    if temp.get("refresh_lock", False):
-        flash("<b>Error.</b> Already refreshing. Please wait or check the console for progress info.", "danger")
-        return redirect(url_for("home"))
 
-    # Start the background refresh thread
-    t = threading.Thread(target=_background_refresh)
-    t.start()
-    flash("<b>Refreshing metadata and new artworks.</b> This operation can take some time.", "success")
+    # Queue the refresh, run in the background by the job executor
+    if jobs.queue.submit("refresh") is None:
+        flash("<b>Error.</b> Already refreshing. Please wait or check the <a href=\"/jobs\">jobs</a> for progress "
+              "info.", "danger")
+        return redirect(url_for("home"))
+    flash("<b>Refreshing metadata and new artworks.</b> This operation can take some time, see the "
+          "<a href=\"/jobs\">jobs</a> for progress info.", "success")
     return redirect(url_for("home"))
 
 
-def _background_refresh():
-    # Get bookmarks, update their metadata locally and download the new ones
+@jobs.queue.handler("refresh")
+def _refresh_job(job):
+    # Get bookmarks, update their metadata locally and download the new ones.
+    # The fetched bookmarks are kept in temp_path until the refresh ends: an interrupted refresh is resumed without
+    # fetching them again, and the bookmarks it already imported are stored, so they aren't downloaded again
+    import pixiv  # pixivpy3 and the downloader are only imported by the first refresh
     print("Now refreshing metadata from pixiv, this can take a while...")
-    temp["refresh_lock"] = True
-    bookmarks = pixiv.get_bookmarks()
-    utils.update_metadata(bookmarks)
-    new = utils.filter_artworks(bookmarks)
-    new.reverse()
-
-    # Download bookmarks to the temporary directory
-    print(f"There are {len(new)} new bookmarks to download.")
-    for b in new:
-        pixiv.download_bookmarks(b)
-
-    # Copy bookmarks to the storage backend (local/remote)
-    print("Bookmarks downloaded. Now importing bookmarks.")
-    for b in new:
-        aw = Artwork(b)
-        artworks[str(aw.id)] = aw.meta
-        for i in aw.original_images:
-            i.fs_upload()
-    artworks.save()
+    temp.sync()  # the sync cursor may have been saved by another worker
+    saved = Path(conf["temp_path"]) / f"job_{job.id}_bookmarks.json"
+    try:
+        if "full" in job.checkpoint and saved.is_file():
+            full = job.checkpoint["full"]
+            bookmarks = loads(saved.read_text(encoding="utf-8"))
+            print(f"Resuming refresh with {len(bookmarks)} fetched bookmarks.")
+        else:
+            full = pixiv.full_sweep_due()
+            job.stage("fetch")
+            bookmarks = pixiv.get_bookmarks(full=full, on_page=lambda n: job.advance("fetch", n))
+            job.end("fetch")
+            saved.write_text(dumps(bookmarks), encoding="utf-8")
+            job.save(full=full)
+        update, new = utils.classify_bookmarks(bookmarks)
+        job.stage("metadata", len(update))
+        for aid in utils.update_metadata(update):
+            files.exports.invalidate(f"{aid}_")  # pages changed, cached exports are outdated
+            files.flattened.invalidate(f"{aid}_")
+            renditions.cache.invalidate(f"{aid}_")
+        artworks.save()
+        job.advance("metadata", len(update))
+        job.end("metadata")
+        new.reverse()
+
+        # Each bookmark is imported to the storage backend (local/remote/s3) and removed from the temporary directory
+        # as soon as it is downloaded, while the next ones are downloading. Local storage skips the temporary directory
+        print(f"There are {len(new)} new bookmarks to download.")
+        job.stage("download", sum(pixiv.image_count(b) for b in new))
+        job.stage("import", len(new))
+        checkpoint = conf.get("refresh", {}).get("checkpoint", 25)
+        imported = []
+        downloaded = {}  # filename -> (size, sha256), recorded for the scrubber once the artwork is imported
+
+        def on_image(dest, _, size, digest):
+            downloaded[Path(dest).name] = (size, digest)
+            job.advance("download", 1, size)
+
+        # Closed on a failure, which removes the images of the bookmarks still downloading
+        with closing(pixiv.download_pipeline(new, conf.get("refresh", {}).get("window", 8), on_image)) as images:
+            for n, b in enumerate(images, start=1):
+                aw = Artwork(b)
+                aw.fs_upload(direct=pixiv.DIRECT)
+                artworks[str(aw.id)] = aw.meta  # only added once all of its images are stored
+                scrub.index.record(aw.id, [(name, *downloaded.pop(name, (None, None)))
+                                           for i in aw.original_images for _, name in i.fs_files()])
+                pixiv.download_cleanup(b)
+                imported.append(aw)
+                job.advance("import")
+                if n % checkpoint == 0:
+                    artworks.save()  # a crash mid-refresh keeps the bookmarks imported so far
+                    print(f"Imported {n}/{len(new)} bookmarks.")
+        artworks.save()
+        job.end("download", "import")
+        job.stage("hash")
+        job.advance("hash", duplicates.index.compute(imported))
+        print(f"Hashed {job.stages['hash']['done']} new pages for duplicate detection.")
+        pixiv.commit_sync(bookmarks, full)
+        print("Successfully refreshed bookmarks.")
+    except Exception:
+        saved.unlink(missing_ok=True)  # failed jobs aren't resumed, the next refresh fetches the bookmarks again
+        raise
+    else:
+        saved.unlink(missing_ok=True)
+    finally:
+        artworks.save()
+        artworks.publish()
+
 
-    # Remove bookmarks from the temporary directory
-    print(f"Bookmarks imported. Now removing temporary bookmarks.")
-    for b in new:
-        pixiv.download_cleanup(b)
-    print("Successfully refreshed bookmarks.")
-    temp["refresh_lock"] = False
+@app.route("/duplicates")
+def duplicates_report():
+    # Groups of near-identical pages of different artworks, found in the perceptual hashes of every page
+    _show_nsfw = utils.get_nsfw("home")
+    _nsfw_pref, _nsfw_user = utils.get_nsfw_state("home")
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    per_page = 50
+    # Hashes of deleted artworks may outlive them (deleted by another worker, or while hashing): their pages are left
+    # out, along with the groups no longer spanning several artworks
+    groups = []
+    for g in duplicates.index.groups():
+        g = [(aid, img) for aid, img in g if aid in artworks]
+        if len({aid for aid, _ in g}) > 1:
+            groups.append(g)
+    pagination = utils.gen_paginate_data(page, ceil(len(groups) / per_page), "/duplicates?page={}", margin=5)
+    shown = []
+    for g in groups[per_page * (page - 1):per_page * page]:
+        shown.append([(Artwork.from_id(aid), img) for aid, img in g])
+    return render_template("duplicates.html", groups=shown, total=len(groups), hashed=duplicates.index.count(),
+                           show_nsfw=_show_nsfw, scanning=utils.hash_lock.locked(), pagination=pagination,
+                           ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
+
+
+@app.route("/duplicates/scan")
+def duplicates_scan():
+    if conf["read_only"]:
+        flash("<b>Application is read-only.</b> Cannot scan artworks.", "danger")
+        return redirect(url_for("duplicates_report"))
+    if not _start_locked(utils.hash_lock, duplicates.scan):
+        flash("<b>Error.</b> Already scanning. Please wait or check the console for progress info.", "danger")
+        return redirect(url_for("duplicates_report"))
+    flash("<b>Hashing artworks.</b> This operation can take some time.", "success")
+    return redirect(url_for("duplicates_report"))
 
 
 @app.route("/display/home", methods=["POST"])
@@ -242,18 +509,52 @@ def artwork_delete(artwork):
         flash("<b>Not found.</b> The requested artwork wasn't found locally.", "danger")
         return redirect(url_for("home"))
 
-    # Start the delete thread
-    t = threading.Thread(target=_background_delete, args=(aw,))
-    t.start()
+    # Queue the deletion, run after the running refresh or deletions if any
+    if jobs.queue.submit("delete", artwork=aw.id) is None:
+        flash(f"<b>Error.</b> Artwork {aw.id} is already being deleted.", "danger")
+        return redirect(url_for("home"))
     flash(f"<b>Success.</b> Now deleting artwork {aw.id}.", "success")
     return redirect(url_for("home"))
 
 
-def _background_delete(aw):
-    for img in aw.original_images:
-        img.fs_delete()
-    artworks.pop(str(aw.id))
+@jobs.queue.handler("delete")
+def _delete_job(job, artwork):
+    aw = Artwork.from_id(artwork)
+    if aw is None:
+        return  # deleted by an interrupted attempt of this job
+    job.stage("delete", len(aw.original_images))
+    aw.fs_delete()
+    artworks.pop(str(aw.id), None)
     artworks.save()
+    artworks.publish()
+    files.exports.invalidate(f"{aw.id}_")
+    files.flattened.invalidate(f"{aw.id}_")
+    renditions.cache.invalidate(f"{aw.id}_")
+    job.advance("delete", len(aw.original_images))
+
+
+@app.route("/jobs")
+@app.route("/jobs/<int:job>")
+def jobs_status(job=None):
+    # Progress of the jobs, as JSON with ?format=json or an Accept: application/json header
+    if job is not None:
+        data = jobs.queue.get(job)
+        if data is None:
+            return {"error": "Unknown job"}, 404
+        return data
+    recent = jobs.queue.recent()
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        return {"jobs": recent}
+    _nsfw_pref, _nsfw_user = utils.get_nsfw_state("home")
+    return render_template("jobs.html", jobs=recent,
+                           time=lambda t: datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"),
+                           ro=conf["read_only"], nsfw_master=_nsfw_pref, nsfw=_nsfw_user)
+
+
+@app.route("/metrics")
+def metrics_export():
+    # Metrics of this worker process, in the Prometheus text format
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/a/<artwork>/pdf")
@@ -271,16 +572,46 @@ def artwork_download(artwork, quality=None):
         flash("<b>Unavailable.</b> The requested artwork quality isn't available.", "danger")
         return redirect(url_for("home"))
 
-    # Download/Copy images to memory. Could theoretically cause a OOM kill to happen, shouldn't happen with pixiv
-    images = [(i, i.fs_get(quality, force_proxy=True)) for i in aw.original_images]
-    if mode == "pdf":
-        obj = make_pdf(images)
-    elif mode == "zip":
-        obj = make_zip(images, quality)
-    else:
-        obj = None  # Shouldn't happen, but required for the PC linter
     filename = f"{aw.id}_{quality}.{mode}"
-    return send_file(obj, as_attachment=True, download_name=filename)
+    key = files.export_key(aw, quality, mode)
+    cached = files.exports.get(key)
+    if cached is None and mode == "zip" and conf.get("export", {}).get("stream", True):
+        # Images are read from storage while the archive is sent (and cached), so it never sits in memory
+        return Response(stream_zip(aw.original_images, quality, key=key), mimetype="application/zip",
+                        headers={"Content-Disposition": f"attachment; filename={filename}", "ETag": f'"{key}"'})
+    if cached is None:
+        with files.exports.write(key) as f:
+            if mode == "pdf":
+                make_pdf(aw.original_images, quality, obj=f)
+            elif mode == "zip":
+                # Download/Copy images to memory. Could theoretically cause a OOM kill to happen
+                obj = make_zip([(i, i.fs_get(quality, force_proxy=True)) for i in aw.original_images], quality)
+                f.write(obj.getbuffer())
+        cached = files.exports.get(key)
+    return send_file(cached, as_attachment=True, download_name=filename, etag=key, conditional=True)
+
+
+IMMUTABLE_AGE = 31536000
+
+
+def _immutable(resp):
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMMUTABLE_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+
+def _rendition(img, width):
+    # Resized copy of the original, in the best format the client accepts. The format is part of the ETag, and caches
+    # must keep one copy per Accept header
+    mimetype, _, ext = fmt = renditions.negotiate(request.accept_mimetypes)
+    tag = f"{img.id}-{img.img}-w{width}-{ext}"
+    path = renditions.renderer.get(img, width, fmt)  # send_file answers 304 if the whole ETag (with the size) matches
+    resp = _immutable(send_file(path, mimetype=mimetype, as_attachment=False,
+                                download_name=f"{img.id}_p{img.img}_w{width}.{ext}", conditional=True,
+                                etag=f"{tag}-{path.stat().st_size}", max_age=IMMUTABLE_AGE))
+    resp.vary.add("Accept")
+    return resp
 
 
 @app.route("/i/<artwork>/<image>")
@@ -291,7 +622,8 @@ def artwork_image(artwork, image, quality=None):
     if aw is None:
         flash("<b>Not found.</b> The requested artwork wasn't found locally.", "danger")
         return redirect(url_for("home"))
-    if quality not in ("original", "large", "medium", "square_medium", "none"):
+    width = renditions.width(quality)
+    if quality not in ("original", "large", "medium", "square_medium", "none") and width is None:
         flash("<b>Unavailable.</b> The requested artwork quality isn't available.", "danger")
         return redirect(url_for("home"))
 
@@ -302,12 +634,33 @@ def artwork_image(artwork, image, quality=None):
         if int(image) < 0:
             raise IndexError  # would theoretically work with -1 for last image, but makes no sense
         img = aw.original_images[int(image)]
-        obj = img.fs_get(quality)
-        if isinstance(obj, str):  # remote storage, no proxy
+        if width is not None:  # renditions have their own ETags, as their responses vary with Accept
+            return _rendition(img, width)
+        # The ETag ends with the size of the stored file, so a file replaced by a scrub isn't answered with a 304
+        tag = f"{img.id}-{img.img}-{quality}"
+        filename = f"{img.id}_p{img.img}_{quality}.{img.get_ext(quality)}"
+        path = img.fs_path(quality)
+        if path is not None:  # local storage, send_file handles conditional and range requests
+            return _immutable(send_file(path, as_attachment=False, download_name=filename, conditional=True,
+                                        etag=f"{tag}-{path.stat().st_size}", max_age=IMMUTABLE_AGE))
+        obj = img.fs_get(quality, stream=True)
+        if isinstance(obj, str):  # remote/s3 storage, no proxy
             return redirect(obj)
-        else:  # local storage or remote storage w/proxy
-            filename = f"{img.id}_p{img.img}_{quality}.{img.ext}"
-            return send_file(obj, as_attachment=False, download_name=filename)
+        else:  # remote/s3 storage w/proxy, the upstream body is streamed to the client
+            resp = send_file(obj, as_attachment=False, download_name=filename, max_age=IMMUTABLE_AGE,
+                             conditional=False, etag=f"{tag}-{obj.size}" if obj.size is not None else False)
+            if obj.size is not None:
+                # send_file doesn't know the length of a stream: conditional and range requests are handled here.
+                # Ranges skip the start of the stream, only cached files can seek
+                resp.content_length = obj.size
+                try:
+                    resp = resp.make_conditional(request.environ, accept_ranges=True, complete_length=obj.size)
+                except RequestedRangeNotSatisfiable:
+                    obj.close()
+                    raise
+            if resp.status_code == 304:
+                obj.close()
+            return _immutable(resp)
     except (IndexError, ValueError, FileNotFoundError):
         flash("<b>Not found.</b> The requested artwork image wasn't found locally.", "danger")
         return redirect(url_for("home"))
@@ -327,11 +680,10 @@ def admin():
     if request.form.get("token_ref"):
         if request.form.get("token_ref").strip() != conf["read_only_token"]:
             return "Invalid token", 403
-        if temp.get("refresh_lock", False):
+        jid = jobs.queue.submit("refresh")
+        if jid is None:
             return "Already refreshing", 400
-        t = threading.Thread(target=_background_refresh)
-        t.start()
-        return "Now refreshing"
+        return f"Now refreshing (job {jid})"
 
     # Initiates an artwork deletion
     if request.form.get("token_del") and request.form.get("artwork"):
@@ -340,10 +692,41 @@ def admin():
         aw = Artwork.from_id(request.form.get("artwork").strip())
         if aw is None:
             return "Unknown artwork", 404
-        t = threading.Thread(target=_background_delete, args=(aw,))
-        t.start()
-        return "Deleting artwork"
+        jid = jobs.queue.submit("delete", artwork=aw.id)
+        if jid is None:
+            return "Already deleting", 400
+        return f"Deleting artwork (job {jid})"
+
+    # Initiates a scrub of the stored images
+    if request.form.get("token_scrub"):
+        if request.form.get("token_scrub").strip() != conf["read_only_token"]:
+            return "Invalid token", 403
+        jid = jobs.queue.submit("scrub", checksums=bool(request.form.get("checksums")))
+        if jid is None:
+            return "Already scrubbing", 400
+        return f"Now scrubbing (job {jid})"
+
+    # Initiates a duplicate detection scan
+    if request.form.get("token_hash"):
+        if request.form.get("token_hash").strip() != conf["read_only_token"]:
+            return "Invalid token", 403
+        if not _start_locked(utils.hash_lock, duplicates.scan):
+            return "Already scanning", 400
+        return "Now scanning"
+
+
+def _warm_up():
+    # Builds the artwork index and checks the store in the background, so the first requests don't wait for them
+    start = time.perf_counter()
+    artworks.warm()
+    if conf.get("startup", {}).get("validate", True):
+        for problem in artworks.validate():
+            print(f"Metadata store check: {problem}")
+    print(f"Metadata store ready in {time.perf_counter() - start:.2f}s.")
+
 
+threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+jobs.queue.start()  # resumes the jobs interrupted by a restart
 
 if __name__ == '__main__':
     app.run()
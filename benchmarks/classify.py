@@ -0,0 +1,46 @@
+import contextlib
+import os
+import time
+
+from benchmarks.corpus import make_bookmarks
+import utils
+from utils import artworks
+
+# Compares the str(dict) scans that were used to classify bookmarks with utils.classify_bookmarks
+# Usage: python -m benchmarks.classify [count]
+
+
+def legacy_classify(aws):
+    update, new = [], []
+    for aw in aws:
+        if str(aw["id"]) not in artworks:
+            pass
+        elif any(x in str(aw) for x in ("limit_unknown_360", "limit_mypixiv_360")) or aw["restrict"] != 0:
+            pass
+        else:
+            update.append(aw)
+    for i in aws:
+        if any(x in str(i) for x in ("limit_unknown_360", "limit_mypixiv_360")) or i["restrict"] != 0:
+            continue
+        if "ugoira" in str(i):
+            continue
+        if str(i["id"]) not in artworks:
+            new.append(i)
+    return update, new
+
+
+def run(count=50000):
+    bookmarks = make_bookmarks(count)
+    results = {}
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        for name, func in (("legacy", legacy_classify), ("classify_bookmarks", utils.classify_bookmarks)):
+            start = time.perf_counter()
+            update, new = func(bookmarks)
+            results[name] = {"seconds": time.perf_counter() - start, "update": len(update), "new": len(new)}
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    for k, v in run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000).items():
+        print(f"{k}: {v['seconds']:.3f}s ({v['update']} updated, {v['new']} new)")
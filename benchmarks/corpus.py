@@ -0,0 +1,49 @@
+import random
+
+# Synthetic bookmarks shaped like the illusts returned by AppPixivAPI.user_bookmarks_illust
+
+
+def make_illust(iid, rng, pages=1, x_restrict=0, kind="illust", limited=False, cdn="https://i.pximg.net"):
+    date = (f"20{rng.randint(10, 22)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            f"T{rng.randint(0, 23):02d}:00:00+09:00")
+    base = f"{cdn}/img-master/img/{date[:4]}/{iid}"
+    user = rng.randint(1, 5000)
+    image_urls = {"square_medium": f"{base}_p0_square1200.jpg", "medium": f"{base}_p0_master1200.jpg",
+                  "large": f"{base}_p0_master1200.jpg"}
+    if limited:
+        image_urls = {k: "https://s.pximg.net/common/images/limit_unknown_360.png" for k in image_urls}
+    illust = {
+        "id": iid, "title": f"Artwork {iid}", "type": kind, "image_urls": image_urls,
+        "caption": f"Caption of artwork {iid} " + "lorem ipsum " * rng.randint(0, 20),
+        "restrict": 0,
+        "user": {"id": user, "name": f"Artist {user}", "account": f"artist_{user}",
+                 "profile_image_urls": {"medium": f"https://i.pximg.net/user-profile/img/{user}_170.jpg"},
+                 "is_followed": False},
+        "tags": [{"name": f"tag{rng.randint(1, 2000)}", "translated_name": rng.choice((None, "translated"))}
+                 for _ in range(rng.randint(1, 10))],
+        "tools": rng.choice(([], ["CLIP STUDIO PAINT"], ["SAI", "Photoshop"])),
+        "create_date": date, "page_count": pages, "width": 1200, "height": 1700, "sanity_level": 2,
+        "x_restrict": x_restrict, "series": None, "meta_single_page": {}, "meta_pages": [],
+        "total_view": rng.randint(0, 10 ** 6), "total_bookmarks": rng.randint(0, 10 ** 5), "is_bookmarked": True,
+        "visible": True, "is_muted": False, "total_comments": 0,
+    }
+    if pages == 1:
+        illust["meta_single_page"] = {"original_image_url": f"{cdn}/img-original/img/{date[:4]}/{iid}_p0.png"}
+    else:
+        illust["meta_pages"] = [{"image_urls": {
+            "square_medium": f"{base}_p{p}_square1200.jpg", "medium": f"{base}_p{p}_master1200.jpg",
+            "large": f"{base}_p{p}_master1200.jpg", "original": f"{cdn}/img-original/img/{date[:4]}/{iid}_p{p}.jpg"}}
+            for p in range(pages)]
+    return illust
+
+
+def make_bookmarks(count, seed=0, cdn="https://i.pximg.net", manga_ratio=0.2, nsfw_ratio=0.3, max_pages=30):
+    # Newest bookmark first, like the pixiv API
+    rng = random.Random(seed)
+    bookmarks = []
+    for iid in range(10 ** 8 + count, 10 ** 8, -1):
+        pages = rng.randint(2, max_pages) if rng.random() < manga_ratio else 1
+        kind = "ugoira" if rng.random() < 0.02 else ("manga" if pages > 1 else "illust")
+        bookmarks.append(make_illust(iid, rng, pages=pages, x_restrict=int(rng.random() < nsfw_ratio), kind=kind,
+                                     limited=rng.random() < 0.01, cdn=cdn))
+    return bookmarks
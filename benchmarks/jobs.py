@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.suite import write_config
+
+# Runs a scrub in a process which only has the scrub handler, like the scrub command, while a refresh and a second
+# scrub are submitted by a process with every handler, like the app. Checks that every job is run, in submission order.
+# Usage: python -m benchmarks.jobs
+
+SCRUB_TIME = 3
+
+
+def scrub_command(tmp, started):
+    import jobs
+    from shared import FileLock
+    queue = jobs.JobQueue(tmp / "jobs.db", FileLock(tmp / "tmp" / "write.lock"))
+    queue.handler("scrub")(lambda job, checksums=False: (started.set(), time.sleep(SCRUB_TIME)))
+    jid = queue.submit("scrub")
+    while queue.get(jid)["state"] in ("queued", "running"):
+        time.sleep(0.1)
+    time.sleep(SCRUB_TIME * 2)  # the process keeps running, with a stopped executor
+
+
+def run():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_config(tmp, None, "local")
+        os.chdir(tmp)  # jobs reads config.json from the working directory
+        import jobs
+        from shared import FileLock
+        started = multiprocessing.Event()
+        command = multiprocessing.Process(target=scrub_command, args=(tmp, started), daemon=True)
+        command.start()
+        started.wait(30)
+        queue = jobs.JobQueue(tmp / "jobs.db", FileLock(tmp / "tmp" / "write.lock"))
+        for kind in ("refresh", "scrub"):
+            queue.handler(kind)(lambda job, **args: None)
+        refresh = queue.submit("refresh")
+        scrub = queue.submit("scrub", checksums=True)
+        deadline = time.time() + SCRUB_TIME + jobs.POLL_INTERVAL * 3
+        while time.time() < deadline and any(queue.get(j)["state"] in ("queued", "running") for j in (refresh, scrub)):
+            time.sleep(0.1)
+        states = {j: queue.get(j) for j in (refresh, scrub)}
+        command.terminate()
+    return {"done": all(s["state"] == "done" for s in states.values()),
+            "order": states[refresh]["finished"] is not None and states[scrub]["finished"] is not None
+            and states[refresh]["finished"] <= states[scrub]["started"]}
+
+
+if __name__ == '__main__':
+    _ok = run()
+    print(f"{', '.join(k for k, v in _ok.items() if v)} ok"
+          + (f", {', '.join(k for k, v in _ok.items() if not v)} failed" if not all(_ok.values()) else ""))
+    print("PASS" if all(_ok.values()) else "FAIL")
+    sys.exit(0 if all(_ok.values()) else 1)
@@ -0,0 +1,60 @@
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.corpus import make_bookmarks
+from store import SQLiteStore
+from search import SearchIndex
+
+# Measures the search index build time and query latency on a synthetic store
+# Usage: python -m benchmarks.search [count]
+
+QUERIES = {
+    "word": {"query": "lorem"},
+    "rare word": {"query": "Artwork 100000042"},
+    "short word": {"query": "ip"},
+    "tag": {"tag": "tag42"},
+    "word + tag": {"query": "ipsum", "tag": "tag42"},
+    "user": {"user": 42},
+    "sfw": {"sfw": True},
+}
+
+
+def timed(func, runs=20):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run(count=100000):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteStore(Path(tmp) / "artworks.db")
+        for b in make_bookmarks(count):
+            store[str(b["id"])] = b
+        store.save()
+        index = SearchIndex(Path(tmp) / "search.db", store)
+        start = time.perf_counter()
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            index.rebuild()
+        results["rebuild"] = time.perf_counter() - start
+        store.listeners.append(index.update)
+        store.save_listeners.append(index.commit)
+        for name, filters in QUERIES.items():
+            results[f"search {name}"] = timed(lambda: index.search(**filters, limit=50))
+            results[f"facets {name}"] = timed(lambda: index.facets(**filters), runs=5)
+        sample = store.get(str(10 ** 8 + 1))
+        results["update"] = timed(lambda: (store.__setitem__(str(10 ** 8 + 1), sample), store.save()))
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    for k, v in run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000).items():
+        print(f"{k}: {v * 1000:.1f}ms")
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchmarks.corpus import make_bookmarks
+from benchmarks.suite import REPO, write_config, prefill
+
+# Compares the memory used by a worker with the json, sqlite and snapshot stores, once it served the home page (both
+# orders), the top page, the pages of a tag and of an artist and every artwork page. Resident memory is split into
+# private memory (anonymous) and pages of mapped files, shared by the workers
+# Usage: python -m benchmarks.snapshot [count]
+
+WORKER = """
+import json, threading, time
+import app
+from utils import artworks
+for t in threading.enumerate():
+    if t.name == "warm-up":
+        t.join()
+start = time.perf_counter()
+c = app.app.test_client()
+c.set_cookie("localhost", "nsfw_state", "true")
+pages = ["/", "/p/1/none/50/artwork", "/top", "/t/tag1", "/u/1"] + [f"/a/{a}" for a in artworks.ids()]
+for url in pages:
+    c.get(url).close()
+elapsed = time.perf_counter() - start
+status = dict(line.split(":", 1) for line in open("/proc/self/status"))
+print(json.dumps({"requests": len(pages), "elapsed": elapsed,
+                  **{k: int(status[k].split()[0]) * 1024 for k in ("VmRSS", "RssAnon", "RssFile")}}))
+"""
+
+
+def worker(tmp):
+    out = subprocess.run([sys.executable, "-c", WORKER], cwd=tmp, capture_output=True, text=True, check=True,
+                         env={**os.environ, "PYTHONPATH": str(REPO)}).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def run(count=10000):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_config(tmp, None, "local")
+        bookmarks = make_bookmarks(count)
+        prefill(tmp, bookmarks)
+        (tmp / "artworks.json").write_text(json.dumps({str(b["id"]): b for b in reversed(bookmarks)}),
+                                           encoding="utf-8")
+        config = json.loads((tmp / "config.json").read_text(encoding="utf-8"))
+        for kind in ("json", "sqlite", "snapshot"):
+            config["store"] = kind
+            config["store_options"] = {"path": str(tmp / ("artworks.json" if kind == "json" else "artworks.db")),
+                                       "snapshot": str(tmp / "artworks.snap")}
+            (tmp / "config.json").write_text(json.dumps(config, indent=4), encoding="utf-8")
+            worker(tmp)  # first run: builds the search index, and the snapshot
+            results[kind] = worker(tmp)
+        results["sizes"] = {name: (tmp / name).stat().st_size
+                            for name in ("artworks.json", "artworks.db", "artworks.snap")}
+    return results
+
+
+if __name__ == '__main__':
+    _results = run(*(int(a) for a in sys.argv[1:2]))
+    for _name, _size in _results.pop("sizes").items():
+        print(f"{_name}: {_size / 1024 ** 2:.1f}MiB")
+    for _kind, _r in _results.items():
+        print(f"{_kind}: RSS {_r['VmRSS'] / 1024 ** 2:.0f}MiB (private {_r['RssAnon'] / 1024 ** 2:.0f}MiB, "
+              f"mapped files {_r['RssFile'] / 1024 ** 2:.0f}MiB), {_r['requests']} requests in "
+              f"{_r['elapsed']:.2f}s")
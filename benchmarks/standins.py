@@ -0,0 +1,220 @@
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+from urllib import parse
+
+from PIL import Image
+
+# Local HTTP servers standing in for the pixiv API, the i.pximg.net CDN and a php-fs storage server, so refreshes and
+# remote storage can be benchmarked without network access. latency (in seconds) is added to every response.
+# S3 is stood in for by an in-memory client with the methods of the boto3 client used by S3Storage
+
+PAGE_SIZE = 30  # bookmarks per page of user_bookmarks_illust
+
+
+def _image(size, fmt):
+    # Noisy image, so that its encoded size is close to a real one
+    im = Image.merge("RGB", [Image.effect_noise(size, s) for s in (40, 60, 80)])
+    b = BytesIO()
+    im.save(b, fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return b.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, status=200, ctype="application/octet-stream"):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+def serve(handler, **attrs):
+    # Starts the server in a daemon thread, returns the server and its base URL
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), type(handler.__name__, (handler,), attrs))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_port}"
+
+
+class PixivAPI(Handler):
+    # /auth/token and /v1/user/bookmarks/illust, paging through bookmarks (newest first) like pixiv.
+    # max_bookmark_id is the index of the next page's first bookmark
+    bookmarks = []
+    calls = 0
+
+    def do_POST(self):
+        self.body()
+        login = {"access_token": "access", "refresh_token": "refresh", "expires_in": 3600,
+                 "user": {"id": "1", "name": "benchmark", "account": "benchmark"}}
+        self.send(json.dumps({**login, "response": login}).encode(), ctype="application/json")
+
+    def do_GET(self):
+        type(self).calls += 1
+        url = parse.urlparse(self.path)
+        args = parse.parse_qs(url.query)
+        if url.path != "/v1/user/bookmarks/illust":
+            return self.send(b"{}", 404, "application/json")
+        start = int(args.get("max_bookmark_id", [0])[0])
+        page = self.bookmarks[start:start + PAGE_SIZE]
+        end = start + len(page)
+        next_url = (f"https://app-api.pixiv.net/v1/user/bookmarks/illust?user_id=1&restrict=public"
+                    f"&max_bookmark_id={end}") if end < len(self.bookmarks) else None
+        self.send(json.dumps({"illusts": page, "next_url": next_url}).encode(), ctype="application/json")
+
+
+class CDN(Handler):
+    # Serves the same generated image for every URL of a size (original, master, square) and format
+    images = {}
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        if "square" in name:
+            key = ((360, 360), "JPEG")
+        elif "master" in name:
+            key = ((600, 850), "JPEG")
+        else:
+            key = ((1200, 1700), "PNG" if name.endswith(".png") else "JPEG")
+        if key not in self.images:
+            self.images[key] = _image(*key)
+        self.send(self.images[key], ctype=f"image/{key[1].lower()}")
+
+
+class PhpFS(Handler):
+    # php-fs: files are stored under root, uploads and deletions need the token
+    root = None
+    token = "benchmark"
+
+    def do_GET(self):
+        p = self.root / parse.unquote(self.path.lstrip("/"))
+        if not p.is_file():
+            return self.send(b"", 404)
+        self.send(p.read_bytes())
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        body = self.body()
+        if self.headers.get("Token") != self.token:
+            return self.send(b"", 403)
+        fields, data = {}, None
+        if self.headers["Content-Type"].startswith("multipart/"):  # uploads, deletions are url-encoded
+            msg = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+            for part in msg.iter_parts():
+                if part.get_filename():
+                    data = part.get_payload(decode=True)
+                else:
+                    fields[part.get_param("name", header="content-disposition")] = part.get_content().strip()
+        else:
+            fields = {k: v[0] for k, v in parse.parse_qs(body.decode()).items()}
+        d = self.root / fields["path"]
+        if self.path.endswith("/upload"):
+            d.mkdir(parents=True, exist_ok=True)
+            (d / fields["file"]).write_bytes(data)
+        else:
+            (d / fields["file"]).unlink(missing_ok=True)
+        self.send(b"ok")
+
+
+class S3ClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class S3NoSuchKey(S3ClientError):
+    def __init__(self):
+        super().__init__("NoSuchKey")
+
+
+class S3Client:
+    # Objects are kept in memory by key, in a single bucket. Deleting a key in failing reports an error for it
+    exceptions = SimpleNamespace(ClientError=S3ClientError, NoSuchKey=S3NoSuchKey)
+
+    def __init__(self, bucket="benchmark"):
+        self.bucket = bucket
+        self.objects = {}
+        self.failing = set()
+        self.delete_calls = 0
+
+    def _check(self, bucket):
+        if bucket != self.bucket:
+            raise S3ClientError("NoSuchBucket")
+
+    def upload_file(self, filename, bucket, key):
+        self._check(bucket)
+        self.objects[key] = Path(filename).read_bytes()
+
+    def get_object(self, Bucket, Key):
+        self._check(Bucket)
+        if Key not in self.objects:
+            raise S3NoSuchKey()
+        return {"Body": BytesIO(self.objects[Key]), "ContentLength": len(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        self._check(Bucket)
+        if Key not in self.objects:
+            raise S3ClientError("404")
+        return {"ContentLength": len(self.objects[Key])}
+
+    def delete_objects(self, Bucket, Delete):
+        self._check(Bucket)
+        assert len(Delete["Objects"]) <= 1000, "DeleteObjects takes up to 1000 keys"
+        self.delete_calls += 1
+        errors = []
+        for o in Delete["Objects"]:
+            if o["Key"] in self.failing:
+                errors.append({"Key": o["Key"], "Code": "AccessDenied"})
+            else:
+                self.objects.pop(o["Key"], None)
+        return {"Errors": errors} if errors else {}
+
+    def generate_presigned_url(self, method, Params, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.invalid/{Params['Key']}?expires={ExpiresIn}"
+
+
+class StandIns:
+    # Starts the stand-ins. The bookmarks served by the pixiv API are set after the start, their image URLs need the
+    # address of the CDN
+    def __init__(self, storage_root=None, latency=0):
+        self.pixiv_server, self.api = serve(PixivAPI, latency=latency)
+        self.cdn_server, self.cdn = serve(CDN, latency=latency)
+        self.fs_server, self.fs = serve(PhpFS, root=Path(storage_root), latency=latency) \
+            if storage_root is not None else (None, None)
+
+    @property
+    def bookmarks(self):
+        return self.pixiv_server.RequestHandlerClass.bookmarks
+
+    @bookmarks.setter
+    def bookmarks(self, bookmarks):
+        self.pixiv_server.RequestHandlerClass.bookmarks = bookmarks
+
+    @property
+    def api_calls(self):
+        return self.pixiv_server.RequestHandlerClass.calls
+
+    def stop(self):
+        for srv in (self.pixiv_server, self.cdn_server, self.fs_server):
+            if srv is not None:
+                srv.shutdown()
+                srv.server_close()
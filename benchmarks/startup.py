@@ -0,0 +1,64 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+from benchmarks.corpus import make_bookmarks
+from benchmarks.suite import REPO, write_config, prefill
+
+# Measures the time to the first response of a new app process, for a thumbnail, the home page and an artwork page,
+# and which heavy modules were imported to answer it.
+# Usage: python -m benchmarks.startup [count] [runs]
+
+HEAVY = ("PIL", "pixivpy3", "requests", "timeago")
+
+FIRST_RESPONSE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+r = app.app.test_client().get(sys.argv[1])
+r.get_data()
+assert r.status_code == 200, r.status_code
+print(json.dumps({"import": imported - start, "first response": time.perf_counter() - start,
+                  "max rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  "modules": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def first_response(tmp, url, runs):
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", FIRST_RESPONSE % (HEAVY,), url], cwd=tmp, capture_output=True,
+                             text=True, check=True, env={**os.environ, "PYTHONPATH": str(REPO)}).stdout
+        results.append(json.loads(out.splitlines()[-1]))
+    return {"import": statistics.median(r["import"] for r in results),
+            "first response": statistics.median(r["first response"] for r in results),
+            "max rss": statistics.median(r["max rss"] for r in results), "modules": results[-1]["modules"]}
+
+
+def run(count=10000, runs=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_config(tmp, None, "local")
+        bookmarks = make_bookmarks(count)
+        prefill(tmp, bookmarks)
+        aid = next(b["id"] for b in bookmarks if "limit" not in b["image_urls"]["square_medium"])
+        b = BytesIO()
+        Image.new("RGB", (360, 360)).save(b, "JPEG")
+        (tmp / "data" / str(aid)).mkdir(parents=True)
+        (tmp / "data" / str(aid) / f"{aid}_p0_square_medium.jpg").write_bytes(b.getvalue())
+        return {name: first_response(tmp, url, runs) for name, url in (
+            ("thumbnail", f"/i/{aid}/0/square_medium"), ("home", "/"), ("artwork", f"/a/{aid}"))}
+
+
+if __name__ == '__main__':
+    for k, v in run(*(int(a) for a in sys.argv[1:3])).items():
+        print(f"{k}: import {v['import'] * 1000:.0f}ms, first response {v['first response'] * 1000:.0f}ms, "
+              f"max RSS {v['max rss'] / 1024 ** 2:.0f}MiB, heavy modules: {', '.join(v['modules']) or 'none'}")
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from benchmarks.standins import S3Client, StandIns
+from benchmarks.suite import write_config
+
+# Round trip of every storage backend: uploads, stats, reads (twice, the second one from the local cache for remote
+# backends), URLs and deletions. php-fs and S3 are stood in for by benchmarks.standins
+# Usage: python -m benchmarks.storage
+
+
+def round_trip(backend, source, count=3):
+    items = [(str(i), f"{i}_p0.jpg") for i in range(1, count + 1)]
+    data = source.read_bytes()
+    ok = {"upload": all(backend.upload_many([(*i, source) for i in items])),
+          "stat": all(backend.stat(*i) == len(data) for i in items)}
+    reads = []
+    for _ in range(2):
+        with backend.open(*items[0], quality="large") as f:
+            reads.append(f.read())
+    ok["open"] = reads == [data, data]
+    ok["cache"] = backend.cache is None or backend.cache.get(f"{items[0][0]}_{items[0][1]}") is not None
+    ok["url"] = backend.redirect is False or backend.url(*items[0]) is not None
+    ok["delete"] = all(backend.delete_many(items))
+    gone = 0
+    for i in items:
+        try:
+            backend.stat(*i)
+        except FileNotFoundError:
+            gone += 1
+    ok["deleted"] = gone == len(items)
+    ok["invalidated"] = backend.cache is None or backend.cache.get(f"{items[0][0]}_{items[0][1]}") is None
+    return ok
+
+
+def s3_batches(backend):
+    # DeleteObjects takes up to 1000 keys: 1001 deletions are 2 requests, and a failed key is reported as such
+    client = backend.client
+    items = [(str(i), "0_p0.jpg") for i in range(1001)]
+    for i in items:
+        client.objects[backend.key(*i)] = b""
+    client.failing = {backend.key(*items[-1])}
+    client.delete_calls = 0
+    results = backend.delete_many(items)
+    return {"batches": client.delete_calls == 2,
+            "failure": results[:-1] == [True] * 1000 and results[-1] is False and len(client.objects) == 1}
+
+
+def run():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_config(tmp, None, "local")
+        os.chdir(tmp)  # the storage package reads config.json from the working directory
+        from disk_cache import DiskCache
+        from storage.local import LocalStorage
+        from storage.remote import RemoteStorage
+        from storage.s3 import S3Storage
+        source = tmp / "source.jpg"
+        source.write_bytes(os.urandom(256 * 1024))
+        standins = StandIns(tmp / "php-fs")
+        qualities = ["large"]
+        try:
+            backends = {
+                "local": LocalStorage(tmp / "data"),
+                "remote": RemoteStorage(standins.fs, "benchmark", cache=DiskCache(tmp / "cache" / "remote", 1024 ** 2),
+                                        cache_qualities=qualities),
+                "s3": S3Storage("benchmark", client=S3Client("benchmark"),
+                                cache=DiskCache(tmp / "cache" / "s3", 1024 ** 2), cache_qualities=qualities),
+            }
+            results = {kind: round_trip(backend, source) for kind, backend in backends.items()}
+            results["s3"].update(s3_batches(backends["s3"]))
+        finally:
+            standins.stop()
+    return results
+
+
+if __name__ == '__main__':
+    _results = run()
+    for _kind, _ok in _results.items():
+        print(f"{_kind}: {', '.join(k for k, v in _ok.items() if v)} ok"
+              + (f", {', '.join(k for k, v in _ok.items() if not v)} failed" if not all(_ok.values()) else ""))
+    _failed = [k for k, ok in _results.items() if not all(ok.values())]
+    print("PASS" if not _failed else f"FAIL: {', '.join(_failed)}")
+    sys.exit(0 if not _failed else 1)
@@ -0,0 +1,133 @@
+import json
+import multiprocessing
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.corpus import make_illust
+from shared import AtomicJSONDict, FileLock
+from store import SQLiteStore
+
+# Runs several processes writing to and reading from the same store, as the workers of a WSGI server would, and checks
+# that the in-memory index of every process stays consistent with the database.
+# Usage: python -m benchmarks.stress [processes] [seconds]
+
+
+def db_entries(store):
+    # Entries of the index, as built from the database
+    tags = {}
+    for aid, name in store.db.execute("SELECT id, name FROM artwork_tags"):
+        tags.setdefault(aid, set()).add(name)
+    return {str(aid): (seq, date, x <= 0, user, tuple(sorted(tags.get(aid, ()))))
+            for aid, seq, date, x, user in store.db.execute(
+                "SELECT id, seq, create_date, x_restrict, user_id FROM artworks")}
+
+
+def writer(tmp, seed, deadline):
+    # Adds, updates and removes artworks under the write lock. The counter is read then written back on purpose:
+    # increments are only lost if two processes hold the lock at the same time
+    rng = random.Random(seed)
+    store = SQLiteStore(Path(tmp) / "artworks.db")
+    lock = FileLock(Path(tmp) / "write.lock")
+    counter = Path(tmp) / "counter"
+    writes = 0
+    while time.time() < deadline:
+        if not lock.acquire():
+            time.sleep(0.001)
+            continue
+        try:
+            counter.write_text(str(int(counter.read_text() or 0) + 1))  # empty while another process writes it
+            for _ in range(rng.randint(1, 20)):
+                aid = rng.randint(1, 500)
+                if rng.random() < 0.2:
+                    store.pop(str(aid), None)
+                else:
+                    store[str(aid)] = make_illust(aid, rng, x_restrict=rng.choice((0, 1)))
+            store.save()
+            writes += 1
+        finally:
+            lock.release()
+    return writes
+
+
+def reader(tmp, deadline):
+    # Syncs the index and compares it with the database, in the same read transaction
+    store = SQLiteStore(Path(tmp) / "artworks.db")
+    store.index  # built now, kept up to date by sync()
+    checks = errors = 0
+    while time.time() < deadline:
+        with store.lock:
+            store.db.execute("BEGIN")
+            try:
+                store.sync()
+                if store.index.entries != db_entries(store):
+                    errors += 1
+                checks += 1
+            finally:
+                store.db.execute("COMMIT")
+        time.sleep(0.005)
+    return checks, errors
+
+
+def json_writer(tmp, deadline):
+    data = AtomicJSONDict(Path(tmp) / "temp.json")
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        data.update({f"key{i}": n for i in range(2000)})
+        data.save()
+    return n
+
+
+def json_reader(tmp, deadline):
+    # Every read must return a whole file, written by a single save()
+    data = AtomicJSONDict(Path(tmp) / "temp.json", data={"key0": 0})  # read by sync()
+    data.mtime = None
+    reads = errors = 0
+    while time.time() < deadline:
+        try:
+            data.sync()
+            if len(set(data.values())) > 1:
+                errors += 1
+        except json.JSONDecodeError:
+            errors += 1
+        reads += 1
+    return reads, errors
+
+
+def run(processes=4, seconds=10):
+    with tempfile.TemporaryDirectory() as tmp:
+        SQLiteStore(Path(tmp) / "artworks.db")  # created before the workers start
+        AtomicJSONDict(Path(tmp) / "temp.json").save()
+        (Path(tmp) / "counter").write_text("0")
+        deadline = time.time() + seconds
+        with multiprocessing.Pool(processes * 2 + 2) as pool:
+            writers = [pool.apply_async(writer, (tmp, i, deadline)) for i in range(processes)]
+            readers = [pool.apply_async(reader, (tmp, deadline)) for _ in range(processes)]
+            jw = pool.apply_async(json_writer, (tmp, deadline))
+            jr = pool.apply_async(json_reader, (tmp, deadline))
+            writes = sum(w.get() for w in writers)
+            checks = [r.get() for r in readers]
+            json_writes, (json_reads, json_errors) = jw.get(), jr.get()
+        results = {
+            "lock": (writes, int((Path(tmp) / "counter").read_text())),
+            "index": (sum(c for c, _ in checks), sum(e for _, e in checks)),
+            "json": (json_writes, json_reads, json_errors),
+        }
+    ok = {
+        "lock": results["lock"][0] == results["lock"][1],
+        "index": results["index"][1] == 0,
+        "json": results["json"][2] == 0,
+    }
+    return results, ok
+
+
+if __name__ == '__main__':
+    import sys
+    _results, _ok = run(*(int(a) for a in sys.argv[1:3]))
+    print(f"lock: {_results['lock'][0]} locked writes, counter at {_results['lock'][1]}")
+    print(f"index: {_results['index'][0]} checks, {_results['index'][1]} inconsistent")
+    print(f"json: {_results['json'][0]} writes, {_results['json'][1]} reads, {_results['json'][2]} partial")
+    print("PASS" if all(_ok.values()) else f"FAIL: {', '.join(k for k, v in _ok.items() if not v)}")
+    sys.exit(0 if all(_ok.values()) else 1)
@@ -0,0 +1,203 @@
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.corpus import make_bookmarks
+from benchmarks.standins import StandIns
+
+# End-to-end benchmarks of the app on a synthetic library, with local stand-ins for pixiv, its CDN and php-fs:
+# startup, home pages, images, ZIP/PDF downloads and a full refresh. Results are written as JSON, and compared with a
+# baseline (a previous results file) to find regressions.
+# Usage: python -m benchmarks.suite [--count 10000] [--new 100] [--storage local|remote] [--latency 0] [--runs 10]
+#                                   [--output results.json] [--baseline baseline.json] [--tolerance 0.25]
+
+REPO = Path(__file__).resolve().parent.parent
+
+# Measures the import and the first response of the app in a new process
+STARTUP = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/").close()
+print(imported - start, time.perf_counter() - start)
+"""
+
+
+def timed(func, runs=10, setup=None):
+    # Median time of func, setup is run before every call without being timed
+    times = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def write_config(tmp, standins, storage):
+    config = json.loads((REPO / "config.json").read_text(encoding="utf-8"))
+    config["pixiv"] = {"access": "", "refresh": "benchmark"}
+    config["read_only"] = False
+    config["temp_path"] = str(tmp / "tmp")
+    config["download"] = {**config.get("download", {}), "rate": 0}
+    config["cache"] = {**config.get("cache", {}), "path": str(tmp / "cache")}
+    config["store"] = "sqlite"
+    config["store_options"] = {"path": str(tmp / "artworks.db"), "migrate_from": str(tmp / "artworks.json")}
+    for section, name in (("search", "search.db"), ("jobs", "jobs.db"), ("scrub", "files.db"),
+                          ("duplicates", "hashes.db")):
+        config[section] = {**config.get(section, {}), "path": str(tmp / name)}
+    if storage == "remote":
+        config["filesystem"] = "remote"
+        config["filesystem_options"] = {"server": standins.fs, "token": "benchmark", "proxy": True, "workers": 8}
+    else:
+        config["filesystem"] = "local"
+        config["filesystem_options"] = {"path": str(tmp / "data"), "workers": 8}
+    (tmp / "config.json").write_text(json.dumps(config, indent=4), encoding="utf-8")
+
+
+def prefill(tmp, bookmarks):
+    # Stores the bookmarks (oldest first, like refreshes) without their images, as if they were synced before
+    from store import SQLiteStore
+    store = SQLiteStore(tmp / "artworks.db")
+    for b in reversed(bookmarks):
+        store[str(b["id"])] = b
+    store.save()
+
+
+def startup(tmp, runs=3):
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", STARTUP], cwd=tmp, capture_output=True, text=True, check=True,
+                             env={**os.environ, "PYTHONPATH": str(REPO)}).stdout
+        times.append([float(t) for t in out.split()[-2:]])
+    return {"startup import": statistics.median(t[0] for t in times),
+            "startup first response": statistics.median(t[1] for t in times)}
+
+
+def run(count=10000, new=100, storage="local", latency=0, runs=10):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        standins = StandIns(tmp / "php-fs" if storage == "remote" else None, latency)
+        bookmarks = make_bookmarks(count, cdn=standins.cdn)
+        standins.bookmarks = bookmarks
+        write_config(tmp, standins, storage)
+        cwd = os.getcwd()
+        os.chdir(tmp)  # the app reads config.json from the working directory
+        sys.path.insert(0, str(REPO))
+        try:
+            prefill(tmp, bookmarks[new:])
+            results.update(startup(tmp))
+            with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+                import app
+                import files
+                import jobs
+                import pixiv
+                import renditions
+                pixiv.app_api.hosts = standins.api
+
+                # Full refresh: every page of bookmarks, the metadata of the stored ones, and the new ones downloaded
+                start = time.perf_counter()
+                jid = jobs.queue.submit("refresh")
+                while (job := jobs.queue.get(jid))["state"] in ("queued", "running"):
+                    time.sleep(0.05)
+                results["refresh"] = time.perf_counter() - start
+            if job["state"] != "done":
+                raise RuntimeError(f"Refresh failed: {job['error']}")
+            for stage in job["stages"]:
+                results[f"refresh {stage['name']}"] = stage["elapsed"]
+            results.update(_requests(app.app.test_client(), bookmarks[:new], files, renditions, runs))
+        finally:
+            os.chdir(cwd)
+            standins.stop()
+    return results
+
+
+def _requests(client, new, files, renditions, runs):
+    results = {}
+
+    def get(url):
+        r = client.get(url, headers={"Accept": "image/avif,image/webp,*/*"})
+        r.get_data()  # streamed bodies are built while they're read
+        r.close()
+        assert r.status_code == 200, f"{url} -> {r.status_code}"
+
+    for nsfw in ("false", "true"):
+        client.set_cookie("localhost", "nsfw_state", nsfw)
+        for ipp in (50, 500):
+            for order in ("default", "artwork"):
+                results[f"home ipp={ipp} order={order} nsfw={nsfw}"] = timed(
+                    lambda: get(f"/p/1/none/{ipp}/{order}"), runs)
+    single = next(b["id"] for b in new if b["page_count"] == 1 and b["type"] != "ugoira" and
+                  "limit" not in b["image_urls"]["large"])
+    manga = next(b["id"] for b in new if b["page_count"] > 4 and b["type"] != "ugoira" and
+                 "limit" not in b["image_urls"]["large"])
+    for quality in ("original", "large", "square_medium"):
+        results[f"image {quality}"] = timed(lambda: get(f"/i/{single}/0/{quality}"), runs)
+    results["image w480 cold"] = timed(lambda: get(f"/i/{single}/0/w480"), runs,
+                                       setup=lambda: renditions.cache.invalidate(f"{single}_"))
+    results["image w480 cached"] = timed(lambda: get(f"/i/{single}/0/w480"), runs)
+    for mode in ("zip", "pdf"):
+        for quality in ("original", "large"):
+            results[f"download {mode} {quality} cold"] = timed(
+                lambda: get(f"/a/{manga}/{mode}/{quality}"), max(runs // 2, 1),
+                setup=lambda: (files.exports.invalidate(f"{manga}_"), files.flattened.invalidate(f"{manga}_")))
+            results[f"download {mode} {quality} cached"] = timed(lambda: get(f"/a/{manga}/{mode}/{quality}"), runs)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    # Returns the benchmarks slower than the baseline by more than tolerance, printing every change
+    regressions = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name}: {value * 1000:.1f}ms (new)")
+            continue
+        change = (value - old) / old if old else 0
+        flag = ""
+        if change > tolerance:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print(f"{name}: {old * 1000:.1f}ms -> {value * 1000:.1f}ms ({change:+.0%}){flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks the app on a synthetic library")
+    parser.add_argument("--count", type=int, default=10000, help="bookmarks in the library")
+    parser.add_argument("--new", type=int, default=100, help="bookmarks downloaded by the refresh")
+    parser.add_argument("--storage", choices=("local", "remote"), default="local")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every stand-in response")
+    parser.add_argument("--runs", type=int, default=10, help="runs of every request, the median is kept")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline", help="results to compare with, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed before a regression")
+    args = parser.parse_args()
+    _results = run(args.count, args.new, args.storage, args.latency, args.runs)
+    if args.output:
+        Path(args.output).write_text(json.dumps({
+            "date": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+            "options": {k: v for k, v in vars(args).items() if k in ("count", "new", "storage", "latency", "runs")},
+            "results": _results}, indent=4), encoding="utf-8")
+    if args.baseline:
+        _base = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        _regressions = compare(_results, _base["results"], args.tolerance)
+        if _base.get("options") != {k: v for k, v in vars(args).items()
+                                    if k in ("count", "new", "storage", "latency", "runs")}:
+            print("Warning: the baseline was run with different options.")
+        print(f"{len(_regressions)} regressions" + (f": {', '.join(_regressions)}" if _regressions else ""))
+        sys.exit(1 if _regressions else 0)
+    for k, v in _results.items():
+        print(f"{k}: {v * 1000:.1f}ms")
@@ -0,0 +1,111 @@
+import os
+import stat
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+# Seconds between two scans of the cache directory, which picks up the files written and removed by other processes
+RESCAN_INTERVAL = 60
+
+
+class DiskCache:
+    # Directory of cached files capped to max_size bytes. The modification time of a file is its last use,
+    # and the least recently used files are removed first when the cache grows past its size.
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.scanned = 0
+        self.size = sum(size for _, size, _ in self._files())
+
+    def get(self, key):
+        # Returns the path of the cached file, or None
+        p = self.path / key
+        try:
+            os.utime(p)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return p
+
+    @contextmanager
+    def write(self, key):
+        # Yields a file to write to, only added to the cache once the block exits without error
+        tmp = self.tmp_path(key)
+        try:
+            with tmp.open("wb") as f:
+                yield f
+            self.put(key, tmp)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def tmp_path(self, key):
+        # Path to write a file to before moving it to the cache with put(), ignored by the cache until then
+        return self.path / f".{key}.{uuid4().hex}"
+
+    def put(self, key, source):
+        # Moves the file at source (usually from tmp_path) to the cache
+        source = Path(source)
+        size = source.stat().st_size
+        with self.lock:
+            dest = self.path / key
+            try:
+                self.size -= dest.stat().st_size
+            except FileNotFoundError:
+                pass
+            source.replace(dest)
+            self.size += size
+        self.evict()
+        return self.path / key
+
+    def _files(self):
+        # (mtime, size, path) of the cached files. The directory can be shared by several processes, so files can
+        # be removed by another one while it is read
+        files = []
+        for f in self.path.iterdir():
+            if f.name.startswith("."):
+                continue
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((st.st_mtime, st.st_size, f))
+        self.scanned = time.monotonic()
+        return files
+
+    def evict(self):
+        # The size is counted by this process, and read from the directory now and then to include the files added and
+        # removed by the other processes sharing it, or when the cache may have to be shrunk
+        with self.lock:
+            if self.size <= self.max_size and time.monotonic() - self.scanned < RESCAN_INTERVAL:
+                return
+            files = self._files()
+            self.size = sum(size for _, size, _ in files)
+            if self.size <= self.max_size:
+                return
+            for _, size, f in sorted(files):
+                if self.size <= self.max_size:
+                    break
+                self.size -= size
+                f.unlink(missing_ok=True)
+
+    def invalidate(self, prefix=""):
+        # Removes every cached file whose key starts with prefix
+        with self.lock:
+            for f in self.path.glob(f"{prefix}*"):
+                if f.name.startswith("."):
+                    continue
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    f.unlink(missing_ok=True)
+                    self.size -= st.st_size
@@ -0,0 +1,128 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib import parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class IncompleteDownload(Exception):
+    # The body ended before Content-Length bytes were received
+    pass
+
+
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                IncompleteDownload)
+
+
+class HostLimiter:
+    # Bounds the number of simultaneous requests and the request rate for a single host
+    def __init__(self, concurrency, rate):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self):
+        # Reserve the next request slot, then sleep until it comes
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Downloader:
+    def __init__(self, workers=8, per_host=4, rate=10, retries=4, backoff=1.0, timeout=30, chunk_size=65536):
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # A single keep-alive session shared by every worker, with enough pooled connections for all of them
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+    def _limiter(self, url):
+        host = parse.urlparse(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(self.per_host, self.rate)
+            return self.limiters[host]
+
+    def _retry_delay(self, attempt, r=None):
+        # Honour Retry-After when the server sends it (429/503), otherwise back off exponentially
+        if r is not None and r.headers.get("Retry-After", "").isdigit():
+            return int(r.headers["Retry-After"])
+        return self.backoff * 2 ** attempt
+
+    def fetch(self, url, dest, headers=None):
+        # Streams url to dest through a .part file next to it, renamed once its size matches the Content-Length,
+        # so a partial download never looks like a complete one, even when dest is the final storage location.
+        # Returns the status code (0 on a failure), the number of bytes written and their sha256.
+        dest = Path(dest)
+        part = dest.with_name(dest.name + ".part")
+        limiter = self._limiter(url)
+        start = time.monotonic()
+        status, size, digest = 0, 0, None
+        for attempt in range(self.retries + 1):
+            try:
+                with limiter.semaphore:
+                    limiter.wait()
+                    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                        status = r.status_code
+                        if r.status_code in RETRY_STATUS and attempt < self.retries:
+                            delay = self._retry_delay(attempt, r)
+                        elif r.ok:
+                            h = hashlib.sha256()
+                            with part.open("wb") as f:
+                                for chunk in r.iter_content(self.chunk_size):
+                                    f.write(chunk)
+                                    h.update(chunk)
+                                    size += len(chunk)
+                            expected = r.headers.get("Content-Length")
+                            if expected is not None and "Content-Encoding" not in r.headers and int(expected) != size:
+                                raise IncompleteDownload(f"{size}/{expected}B")
+                            part.replace(dest)
+                            digest = h.hexdigest()
+                            break
+                        else:
+                            break
+            except RETRY_ERRORS:
+                status, size = 0, 0
+                part.unlink(missing_ok=True)
+                if attempt >= self.retries:
+                    break
+                delay = self._retry_delay(attempt)
+            except BaseException:
+                part.unlink(missing_ok=True)  # the body is only kept once complete and renamed to dest
+                raise
+            print(f"retry: {dest} -> {status or 'connection error'}, waiting {delay}s")
+            time.sleep(delay)
+        elapsed = time.monotonic() - start
+        metrics.downloads.observe(elapsed, status)
+        metrics.download_bytes.inc(size)
+        print(f"queue: {dest} - {size}B in {int(elapsed * 1000)}ms -> {status}")
+        return status, size, digest
+
+    def submit(self, url, dest, headers=None):
+        return self.pool.submit(self.fetch, url, dest, headers)
+
+    def fetch_all(self, queue):
+        # queue is a list of (url, dest, headers), downloaded concurrently. Results are returned in the same order
+        futures = [self.submit(*q) for q in queue]
+        return [f.result() for f in futures]
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from utils import conf, artworks
+from objects import Artwork
+
+# Hashes are computed from the smallest rendition, which is enough to compare images and cheap to read
+HASH_QUALITY = "square_medium"
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class MultiIndex:
+    # Multi-index hashing: hashes are split in max_distance + 1 chunks, and two hashes within max_distance of each
+    # other have at least one identical chunk. Only the hashes sharing a chunk with the searched one are compared.
+    # (A BK-tree degrades to comparing most hashes with 64-bit hashes, as their distances are all close to 32)
+    def __init__(self, max_distance, bits=64):
+        self.max_distance = max_distance
+        n = max_distance + 1
+        self.chunks = [(bits * i // n, bits * (i + 1) // n) for i in range(n)]  # bit ranges
+        self.tables = [{} for _ in self.chunks]
+
+    def _keys(self, h):
+        return [(h >> start) & ((1 << (end - start)) - 1) for start, end in self.chunks]
+
+    def add(self, h, item):
+        for table, key in zip(self.tables, self._keys(h)):
+            table.setdefault(key, []).append((h, item))
+
+    def search(self, h):
+        # Returns (distance, item) of every item within max_distance of h
+        found = {}
+        for table, key in zip(self.tables, self._keys(h)):
+            for other, item in table.get(key, ()):
+                if item not in found:
+                    d = distance(h, other)
+                    if d <= self.max_distance:
+                        found[item] = d
+        return [(d, i) for i, d in found.items()]
+
+
+class HashIndex:
+    # Perceptual hashes of every page, kept in a separate SQLite database so they survive metadata updates.
+    # Pages are keyed by their image URL, so a page replaced on pixiv is hashed again
+    def __init__(self, path, store, max_distance=4, workers=None):
+        self.path = Path(path)
+        self.store = store
+        self.max_distance = max_distance
+        self.workers = workers
+        self.lock = threading.RLock()
+        self._pool = None
+        self._groups = None  # near-duplicate groups, cleared when hashes change
+        self._groups_version = None  # data_version the groups were computed at, changed by other processes' commits
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    id INTEGER NOT NULL,
+                    page INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    PRIMARY KEY (id, page)
+                )
+            """)
+            self.db.commit()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def update(self, aid):
+        # Store listener, removes the hashes of deleted artworks and of pages whose image changed
+        meta = self.store.get(str(aid))
+        with self.lock:
+            if meta is None:
+                self.db.execute("DELETE FROM hashes WHERE id = ?", (int(aid),))
+            else:
+                urls = {i.img: i.get_url(HASH_QUALITY) for i in Artwork(meta).original_images}
+                for page, url in self.db.execute("SELECT page, url FROM hashes WHERE id = ?", (int(aid),)).fetchall():
+                    if urls.get(page) != url:
+                        self.db.execute("DELETE FROM hashes WHERE id = ? AND page = ?", (int(aid), page))
+            self.db.commit()
+            self._groups = None
+
+    def missing(self, aws):
+        # Pages of the given artworks without a hash for their current image
+        with self.lock:
+            known = set(self.db.execute("SELECT id, page, url FROM hashes").fetchall())
+        return [i for aw in aws for i in aw.original_images if (i.id, i.img, i.get_url(HASH_QUALITY)) not in known]
+
+    def compute(self, aws):
+        # Hashes the pages missing a hash. Images are read here while the previous ones are hashed by the pool
+        import imaging
+        images = self.missing(aws)
+        pending = deque()
+        done = 0
+        for n, img in enumerate(images, start=1):
+            try:
+                data = img.fs_get(HASH_QUALITY, force_proxy=True).getvalue()
+            except FileNotFoundError:
+                print(f"hash: {img.id}_p{img.img} -> missing {HASH_QUALITY} image")
+                continue
+            pending.append((img, self.pool.submit(imaging.dhash, data)))
+            while len(pending) > (self.workers or 4) * 4:
+                done += self._save(*pending.popleft())
+            if n % 1000 == 0:
+                print(f"Hashed {n}/{len(images)} pages.")
+        while pending:
+            done += self._save(*pending.popleft())
+        with self.lock:
+            self.db.commit()
+            self._groups = None
+        return done
+
+    def _save(self, img, future):
+        try:
+            h = future.result()
+        except Exception as e:  # corrupted or unsupported images are skipped, they'll be retried on the next scan
+            print(f"hash: {img.id}_p{img.img} -> {e}")
+            return 0
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes (id, page, url, hash) VALUES (?, ?, ?, ?)",
+                            (img.id, img.img, img.get_url(HASH_QUALITY), f"{h:016x}"))
+        return 1
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def groups(self):
+        # Groups of pages of different artworks within max_distance of each other, largest groups first.
+        # Each page is searched in a multi-index of every hash, and the pairs found are merged with a union-find
+        with self.lock:
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if self._groups is not None and self._groups_version == version:
+                return self._groups
+            self._groups_version = version
+            rows = [((aid, page), int(h, 16)) for aid, page, h in self.db.execute("SELECT id, page, hash FROM hashes")]
+            hashes = MultiIndex(self.max_distance)
+            for item, h in rows:
+                hashes.add(h, item)
+            parent = {}
+
+            def find(x):
+                while parent.get(x, x) != x:
+                    parent[x] = parent.get(parent[x], parent[x])
+                    x = parent[x]
+                return x
+
+            for item, h in rows:
+                for _, other in hashes.search(h):
+                    if other[0] != item[0]:
+                        parent.setdefault(item, item)
+                        parent.setdefault(other, other)
+                        parent[find(other)] = find(item)
+            groups = {}
+            for item in parent:
+                groups.setdefault(find(item), []).append(item)
+            self._groups = sorted((sorted(g) for g in groups.values() if len({i[0] for i in g}) > 1),
+                                  key=lambda g: (-len(g), g[0]))
+            return self._groups
+
+
+index = HashIndex(conf.get("duplicates", {}).get("path", "hashes.db"), artworks,
+                  conf.get("duplicates", {}).get("distance", 4), conf.get("duplicates", {}).get("workers"))
+artworks.listeners.append(index.update)
+
+
+def scan():
+    # Hashes every stored page that wasn't hashed yet
+    print("Hashing artworks for duplicate detection...")
+    done = index.compute(Artwork.from_id(a) for a in artworks.ids())
+    print(f"Hashed {done} pages, {len(index.groups())} groups of duplicates found.")
+
+
+if __name__ == '__main__':
+    # Usage: python duplicates.py
+    scan()
@@ -1,54 +1,147 @@
 from io import BytesIO
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from time import localtime
 
 from typing import Tuple
 from objects import OriginalArtworkImage
+from utils import conf
+from disk_cache import DiskCache
 
-import img2pdf
-from PIL import Image
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
 
-from zipfile import ZipFile, ZIP_BZIP2
+CHUNK_SIZE = 65536
+# Already compressed formats, compressing them again only costs CPU time
+STORED_EXTS = ("png", "jpg", "jpeg", "gif", "webp")
 
-img2pdf_exceptions = (img2pdf.UnsupportedColorspaceError, img2pdf.JpegColorspaceError,
-                      img2pdf.AlphaChannelError, img2pdf.ImageOpenError, img2pdf.PdfTooLargeError)
+# Generated PDF/ZIP exports, keyed by artwork id, quality, format and images
+exports = DiskCache(f"{conf.get('cache', {}).get('path', './cache')}/exports",
+                    conf.get("cache", {}).get("exports", 2 * 1024 ** 3))
 
 
-def make_pdf(images: list[Tuple[OriginalArtworkImage, BytesIO]]):
-    obj = BytesIO()
-    # Strip OriginalArtworkImage metadata from list, return only BytesIOs
-    files = [x[1] for x in images]
-    try:  # Try a direct conversion. May not always be successful because of alpha channels
-        obj.write(img2pdf.convert(files))
-    except img2pdf_exceptions:
-        t_files = convert_images(files)  # Convert images to standard JPEG and retry
-        obj.write(img2pdf.convert(t_files))
-    obj.seek(0)  # Seeks the BytesIO object to 0 as flask reads from the current pointer position
+# PDF pages with transparency, flattened to JPEG
+flattened = DiskCache(f"{conf.get('cache', {}).get('path', './cache')}/flattened",
+                      conf.get("cache", {}).get("flattened", 1024 ** 3))
+_pool = None
+
+
+def get_pool():
+    # Started on first use, so processes only exist if a PDF ever needed converted pages
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=conf.get("export", {}).get("workers"))
+    return _pool
+
+
+def flattened_key(img, quality):
+    return f"{img.id}_p{img.img}_{quality}_{sha1(img.get_url(quality).encode()).hexdigest()[:12]}.jpg"
+
+
+def export_key(aw, quality, mode):
+    # The fingerprint changes with the image URLs, so an export is never served for outdated pages
+    urls = "|".join(i.get_url(quality) for i in aw.original_images)
+    return f"{aw.id}_{quality}_{sha1(urls.encode()).hexdigest()[:16]}.{mode}"
+
+
+def make_pdf(images: list[OriginalArtworkImage], quality, obj=None):
+    # The PDF is written to obj, or to a temporary file once it grows past export.spool_size. Pages are read from
+    # storage (or spooled to disk from remote storage) and written one at a time, so memory doesn't grow with the
+    # page count. The PDF writer (and Pillow) are only imported by the first PDF export
+    from pdf import PDFWriter
+    if obj is None:
+        obj = SpooledTemporaryFile(max_size=conf.get("export", {}).get("spool_size", 16 * 1024 * 1024),
+                                   dir=conf["temp_path"])
+    with TemporaryDirectory(dir=conf["temp_path"]) as tmp:
+        files = []
+        for i in images:
+            filename = f"{i.id}_p{i.img}_{quality}.{i.get_ext(quality)}"
+            if i.fs_path(quality) is not None:  # local storage
+                files.append(str(i.fs_path(quality)))
+                continue
+            with i.fs_get(quality, force_proxy=True, stream=True) as src, open(f"{tmp}/{filename}", "wb") as dest:
+                copyfileobj(src, dest, CHUNK_SIZE)
+            files.append(f"{tmp}/{filename}")
+        # Pages with transparency are flattened to JPEG, or used straight from the cache if a previous PDF of this
+        # artwork flattened them already
+        writer = PDFWriter(obj)
+        for f in convert_images(files, [flattened_key(i, quality) for i in images]):
+            writer.add_image(f)
+        writer.close()
+    obj.seek(0)  # Seeks the file object to 0 as flask reads from the current pointer position
     return obj
 
 
-def convert_images(source):
-    t_files = []
-    for i in source:
-        fg = Image.open(i)
-        if fg.mode in ("P", "RGBA", "LA", "PA"):  # Usually indicates a problematic PNG image with alpha channels
-            fg.load()
-            bg = Image.new("RGB", fg.size, (255, 255, 255))
-            try:
-                bg.paste(fg, mask=fg.split()[3])
-            except IndexError:
-                bg.paste(fg)
-            obj = BytesIO()
-            bg.save(obj, "JPEG", quality=100)
-            t_files.append(obj)
-        else:
-            t_files.append(i)
+def convert_images(source, keys):
+    # Only the pages with alpha channels are flattened, in parallel in the process pool, then cached
+    import imaging
+    jpeg_quality = conf.get("export", {}).get("jpeg_quality", 95)
+    jobs = {}
+    t_files = list(source)
+    for n, (i, key) in enumerate(zip(source, keys)):
+        cached = flattened.get(key)
+        if cached is not None:
+            t_files[n] = str(cached)
+        elif imaging.needs_flattening(i):
+            jobs[n] = (key, get_pool().submit(imaging.flatten, i, str(flattened.tmp_path(key)), jpeg_quality))
+    for n, (key, job) in jobs.items():
+        t_files[n] = str(flattened.put(key, job.result()))
     return t_files
 
 
 def make_zip(images: list[Tuple[OriginalArtworkImage, BytesIO]], quality):
     obj = BytesIO()
     # Read BytesIO and drop them in the archive
-    with ZipFile(obj, 'w', ZIP_BZIP2) as d:
+    with ZipFile(obj, 'w') as d:
         for i, o in images:
-            d.writestr(f"{i.id}_p{i.img}_{quality}.{i.get_ext(quality)}", o.read())
+            ext = i.get_ext(quality)
+            d.writestr(f"{i.id}_p{i.img}_{quality}.{ext}", o.read(),
+                       compress_type=ZIP_STORED if ext in STORED_EXTS else ZIP_DEFLATED)
     obj.seek(0)  # Seeks the BytesIO object to 0 as flask reads from the current pointer position
     return obj
+
+
+class _ChunkWriter:
+    # Write-only, unseekable file collecting what ZipFile writes, so it can be yielded to the client
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(images: list[OriginalArtworkImage], quality, key=None):
+    # Generator yielding the archive while the images are read from storage, one chunk at a time.
+    # If a cache key is given, the archive is also written to the export cache once it is complete
+    if key is not None:
+        with exports.write(key) as f:
+            for chunk in stream_zip(images, quality):
+                f.write(chunk)
+                yield chunk
+        return
+    out = _ChunkWriter()
+    with ZipFile(out, 'w') as d:
+        for i in images:
+            ext = i.get_ext(quality)
+            info = ZipInfo(f"{i.id}_p{i.img}_{quality}.{ext}", date_time=localtime()[:6])
+            info.compress_type = ZIP_STORED if ext in STORED_EXTS else ZIP_DEFLATED
+            with i.fs_get(quality, force_proxy=True, stream=True) as src, d.open(info, 'w') as dest:
+                while chunk := src.read(CHUNK_SIZE):
+                    dest.write(chunk)
+                    yield out.pop()
+    yield out.pop()
@@ -0,0 +1,72 @@
+from io import BytesIO
+
+from PIL import Image
+
+# Image processing functions run in worker processes. This module only depends on PIL so that workers stay light.
+
+# Modes of images with an alpha channel, palette images can also have a transparent color
+ALPHA_MODES = ("RGBA", "LA", "PA")
+
+
+def needs_flattening(source):
+    # Only reads the image header
+    with Image.open(source) as fg:
+        return fg.mode in ALPHA_MODES or (fg.mode == "P" and "transparency" in fg.info)
+
+
+def flatten(source, dest, quality=95):
+    # Pastes the image on a white background and saves it as JPEG to dest
+    with Image.open(source) as fg:
+        fg.load()
+        bg = Image.new("RGB", fg.size, (255, 255, 255))
+        try:
+            bg.paste(fg, mask=fg.convert("RGBA").split()[3] if fg.mode in ("P", "PA") else fg.split()[3])
+        except IndexError:
+            bg.paste(fg)
+        bg.save(dest, "JPEG", quality=quality)
+    return dest
+
+
+def dhash(source, size=8):
+    # Difference hash: one bit per pair of horizontally adjacent pixels of a (size + 1) x size grayscale thumbnail,
+    # set if the left pixel is brighter. Similar images have hashes with a small hamming distance
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    with Image.open(source) as im:
+        im.draft("L", (size * 4, size * 4))  # lets the JPEG decoder downscale while decoding
+        px = list(im.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    h = 0
+    for row in range(size):
+        for col in range(size):
+            h = h << 1 | (px[row * (size + 1) + col] > px[row * (size + 1) + col + 1])
+    return h
+
+
+def save_formats():
+    # Formats Pillow can write, AVIF depends on the Pillow version and build
+    Image.init()
+    return set(Image.SAVE)
+
+
+def render(source, dest, width, fmt, quality=80):
+    # Downscales the image to width (never upscales) and saves it as fmt to dest. Transparency is kept in formats
+    # supporting it, JPEG gets a white background
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    with Image.open(source) as im:
+        im.draft("RGB", (width, width * im.height // im.width))  # lets the JPEG decoder downscale while decoding
+        if im.width > width:
+            im = im.resize((width, max(round(im.height * width / im.width), 1)), Image.LANCZOS,
+                           reducing_gap=3.0)
+        alpha = im.mode in ALPHA_MODES
+        if fmt == "JPEG" or not alpha:
+            if alpha:
+                rgba = im.convert("RGBA")
+                im = Image.new("RGB", im.size, (255, 255, 255))
+                im.paste(rgba, mask=rgba.split()[3])
+            else:
+                im = im.convert("RGB")
+        else:
+            im = im.convert("RGBA")
+        im.save(dest, fmt, quality=quality)
+    return dest
@@ -0,0 +1,265 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils import conf, temp, write_lock
+import metrics
+
+# Interrupted jobs are resumed this many times before being marked as failed
+MAX_ATTEMPTS = 3
+# Finished jobs kept in the history
+HISTORY = 200
+# Seconds between two attempts to take the lock, by a worker waiting to run a job
+POLL_INTERVAL = 2
+
+
+def _stage_stats(stage, now):
+    # Throughput and ETA of a stage, from the time it started
+    elapsed = (stage["finished"] or now) - stage["started"]
+    rate = stage["done"] / elapsed if elapsed > 0 else 0
+    eta = None
+    if stage["total"] is not None and rate and not stage["finished"]:
+        eta = max(stage["total"] - stage["done"], 0) / rate
+    return {**stage, "elapsed": elapsed, "rate": rate, "byte_rate": stage["bytes"] / elapsed if elapsed > 0 else 0,
+            "eta": eta}
+
+
+class Job:
+    # A job being run by the executor. Handlers report their progress per stage with stage(), advance() and end(),
+    # written to the queue at most once per second so other workers can display it. Stages can overlap (images are
+    # downloaded while the previous bookmarks are imported)
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.args = row["args"]
+        self.checkpoint = row["checkpoint"]
+        self.stages = (row["progress"] or {}).get("stages", {})  # kept when resumed, for the stages it skips
+        self.lock = threading.Lock()
+        self.flushed = 0
+
+    def stage(self, name, total=None):
+        with self.lock:
+            self.stages[name] = {"done": 0, "total": total, "bytes": 0, "started": time.time(), "finished": None}
+        self.flush(force=True)
+
+    def advance(self, name, n=1, size=0):
+        # Thread-safe, downloads report their progress from the downloader threads
+        with self.lock:
+            self.stages[name]["done"] += n
+            self.stages[name]["bytes"] += size
+        self.flush()
+
+    def end(self, *names):
+        # Ends the given stages, or every stage if none is given
+        with self.lock:
+            for name in names or self.stages:
+                if not self.stages[name]["finished"]:
+                    self.stages[name]["finished"] = time.time()
+        self.flush(force=True)
+
+    def save(self, **checkpoint):
+        # Saves values needed to resume the job if it is interrupted
+        self.checkpoint.update(checkpoint)
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        if not force and time.monotonic() - self.flushed < 1:
+            return
+        with self.lock:
+            self.flushed = time.monotonic()
+            progress = json.dumps({"stages": self.stages})
+        self.queue._update(self.id, progress=progress, checkpoint=json.dumps(self.checkpoint))
+
+
+class JobQueue:
+    # Persistent queue of the jobs writing to the store or to the storage (refresh, delete, scrub), in a SQLite database
+    # shared by every worker. Any worker can submit a job, but they are only run by the executor thread of the worker
+    # holding the write lock, one at a time and in submission order. A job left running by a crashed worker is resumed
+    # by the next executor, the lock being released by the system when its process ends.
+    # A process without a handler for the next job (the scrub command only runs scrubs) stops its executor, and the
+    # worker which submitted it, waiting for the lock since, runs it.
+    def __init__(self, path, lock):
+        self.path = Path(path)
+        self.lock = lock
+        self.handlers = {}  # kind -> function(job, **args)
+        self.db_lock = threading.RLock()
+        self.wait_lock = threading.Lock()
+        self.waiting = False
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db_lock:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    error TEXT,
+                    checkpoint TEXT NOT NULL DEFAULT '{}',
+                    progress TEXT
+                )
+            """)
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            self.db.commit()
+
+    def handler(self, kind):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def _update(self, jid, **values):
+        with self.db_lock:
+            self.db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in values)} WHERE id = ?",
+                            (*values.values(), jid))
+            self.db.commit()
+
+    @staticmethod
+    def _row(row):
+        return {**dict(row), "args": json.loads(row["args"]), "checkpoint": json.loads(row["checkpoint"]),
+                "progress": json.loads(row["progress"]) if row["progress"] else None}
+
+    def submit(self, kind, **args):
+        # Returns the id of the new job, or None if the same job is already waiting or running
+        encoded = json.dumps(args, sort_keys=True)
+        with self.db_lock:
+            self.db.execute("BEGIN IMMEDIATE")  # no other worker can submit between the check and the insert
+            if self.db.execute("SELECT 1 FROM jobs WHERE kind = ? AND args = ? AND state IN ('queued', 'running')",
+                               (kind, encoded)).fetchone():
+                self.db.rollback()
+                self.start()  # the executor may have stopped before it, in a process that can't run it
+                return None
+            jid = self.db.execute("INSERT INTO jobs (kind, args, state, created) VALUES (?, ?, 'queued', ?)",
+                                  (kind, encoded, time.time())).lastrowid
+            self.db.commit()
+        self.start()
+        return jid
+
+    def start(self):
+        # Starts the executor in this worker, unless a worker already runs it. That worker picks up the new jobs,
+        # this one waits for the lock in case the executor stops before them
+        if not self.lock.acquire():
+            self._wait()
+            return False
+        threading.Thread(target=self._run, name="jobs", daemon=True).start()
+        return True
+
+    def _wait(self):
+        with self.wait_lock:
+            if self.waiting:
+                return
+            self.waiting = True
+        threading.Thread(target=self._poll, name="jobs-wait", daemon=True).start()
+
+    def _poll(self):
+        # Tries to take the lock while the next job can be run by this process, and runs the executor once it has it
+        while True:
+            time.sleep(POLL_INTERVAL)
+            if self.lock.acquire():
+                with self.wait_lock:
+                    self.waiting = False
+                self._run()
+                return
+            with self.wait_lock:
+                if not self._runnable():
+                    self.waiting = False
+                    return
+
+    def _recover(self):
+        # Jobs can only be running while their worker holds the lock: the ones left running were interrupted
+        with self.db_lock:
+            for row in self.db.execute("SELECT id, attempts FROM jobs WHERE state = 'running'").fetchall():
+                if row["attempts"] >= MAX_ATTEMPTS:
+                    self._update(row["id"], state="failed", finished=time.time(), error="Interrupted too many times")
+                else:
+                    print(f"Resuming interrupted job {row['id']}.")
+                    self._update(row["id"], state="queued")
+        if temp.pop("refresh_lock", None) is not None:  # flag used by older versions, possibly left set by a crash
+            temp.save()
+
+    def _queued(self):
+        # Next queued job, whatever its kind
+        with self.db_lock:
+            return self.db.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+
+    def _runnable(self):
+        # Whether the next queued job has a handler in this process (the scrub command only runs scrubs, the app runs
+        # every job)
+        row = self._queued()
+        return row is not None and row["kind"] in self.handlers
+
+    def _next(self):
+        with self.db_lock:
+            row = self._queued()
+            if row is None or row["kind"] not in self.handlers:
+                return None  # the lock is handed back to a process that can run it
+            self._update(row["id"], state="running", started=time.time(), attempts=row["attempts"] + 1)
+            return Job(self, self._row(row))
+
+    def _run(self):
+        try:
+            self._recover()
+            while (job := self._next()) is not None:
+                self._execute(job)
+            self._prune()
+        finally:
+            self.lock.release()
+        # A job may have been submitted by another worker after the queue was found empty, but before the lock was
+        # released: that worker couldn't start the executor
+        if self._runnable():
+            self.start()
+
+    def _execute(self, job):
+        print(f"Running job {job.id} ({job.kind}).")
+        try:
+            self.handlers[job.kind](job, **job.args)
+        except Exception as e:
+            job.end()
+            self._update(job.id, state="failed", finished=time.time(), error=f"{type(e).__name__}: {e}")
+            metrics.jobs.inc(1, job.kind, "failed")
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+            return
+        job.end()
+        self._update(job.id, state="done", finished=time.time())
+        metrics.jobs.inc(1, job.kind, "done")
+        for name, stage in job.stages.items():
+            metrics.job_stages.observe(stage["finished"] - stage["started"], job.kind, name)
+
+    def _prune(self):
+        with self.db_lock:
+            self.db.execute("""
+                DELETE FROM jobs WHERE state IN ('done', 'failed') AND id NOT IN (
+                    SELECT id FROM jobs WHERE state IN ('done', 'failed') ORDER BY id DESC LIMIT ?
+                )
+            """, (HISTORY,))
+            self.db.commit()
+
+    def get(self, jid):
+        with self.db_lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (jid,)).fetchone()
+        return self.describe(self._row(row)) if row else None
+
+    def recent(self, limit=50):
+        with self.db_lock:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self.describe(self._row(r)) for r in rows]
+
+    @staticmethod
+    def describe(job):
+        # Job as shown by /jobs, with the throughput and ETA of every stage
+        now = time.time()
+        stages = (job.pop("progress") or {}).get("stages", {})
+        job.pop("checkpoint")
+        job["stages"] = [{"name": name, **_stage_stats(s, now)} for name, s in stages.items()]
+        return job
+
+
+queue = JobQueue(conf.get("jobs", {}).get("path", "jobs.db"), write_lock)
@@ -0,0 +1,124 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Counters and histograms kept in memory by each process, and exposed in the Prometheus text format by /metrics.
+# Recording a value only takes a lock and a few additions, so it can be done on every request
+
+# Upper bounds (in seconds) of the histogram buckets
+LATENCY = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600)
+
+registry = []
+
+
+def _labels(names, values):
+    return "{" + ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + "}" if names else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+        registry.append(self)
+
+    def samples(self):
+        # (suffix, label names, label values, value) of every sample
+        with self.lock:
+            return [("", self.labels, k, v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(names, values)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, n=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            h = self.values.get(labels)
+            if h is None:
+                h = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]  # counts per bucket, sum, count
+            h[0][bisect_left(self.buckets, value)] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        samples = []
+        names = self.labels + ("le",)
+        with self.lock:
+            for k, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += n
+                    samples.append(("_bucket", names, k + (bound,), cumulative))
+                samples.append(("_sum", self.labels, k, total))
+                samples.append(("_count", self.labels, k, count))
+        return samples
+
+
+class Collected(Metric):
+    # Metric whose values are read when /metrics is requested, from a function returning {label values: value}
+    def __init__(self, name, doc, labels, func, type="gauge"):
+        super().__init__(name, doc, labels)
+        self.func = func
+        self.type = type
+
+    def samples(self):
+        return [("", self.labels, k, v) for k, v in self.func().items()]
+
+
+def render():
+    out = []
+    for m in registry:
+        try:
+            out.append(m.render())
+        except Exception as e:  # a failing collector shouldn't hide the other metrics
+            print(f"metrics: {m.name} -> {type(e).__name__}: {e}")
+    return "\n".join(out) + "\n"
+
+
+requests = Histogram("pbe_request_duration_seconds", "Time spent handling requests, until the body was sent",
+                     ("endpoint",))
+responses = Counter("pbe_responses_total", "Responses sent", ("endpoint", "status"))
+storage_latency = Histogram("pbe_storage_duration_seconds", "Time spent in storage backend operations",
+                            ("backend", "operation"))
+storage_bytes = Counter("pbe_storage_bytes_total", "Bytes read from and written to the storage backend",
+                        ("backend", "operation"))
+pixiv_api = Histogram("pbe_pixiv_api_duration_seconds", "Time spent in pixiv API calls", ("method",))
+pixiv_api_errors = Counter("pbe_pixiv_api_errors_total", "pixiv API calls that raised an error", ("method",))
+downloads = Histogram("pbe_download_duration_seconds", "Time spent downloading images from pixiv, retries included",
+                      ("status",))
+download_bytes = Counter("pbe_download_bytes_total", "Bytes of images downloaded from pixiv")
+job_stages = Histogram("pbe_job_stage_duration_seconds", "Duration of the stages of finished jobs",
+                       ("kind", "stage"), buckets=DURATION)
+jobs = Counter("pbe_jobs_total", "Jobs run by this process", ("kind", "state"))
@@ -1,18 +1,26 @@
 from datetime import datetime
-import timeago
 
-import requests
 from pathlib import Path
-from shutil import copyfile
 from urllib import parse
 from io import BytesIO
 
 from utils import conf, artworks, now_tz
+import storage
 
 from .user import User
+from .cache import LRUCache
+
+# Artworks are built once and reused until the store changes them
+cache = LRUCache(conf.get("cache", {}).get("artworks", 1024))
+artworks.listeners.append(cache.invalidate)
+artworks.remote_listeners.append(cache.invalidate)
 
 
 class Artwork:
+    __slots__ = ("id", "title", "caption", "user", "nsfw_level", "nsfw", "tools", "width", "height", "page_count",
+                 "sanity_level", "restrict", "type", "views", "bookmarks", "meta",
+                 "_tags", "_post_date", "_original_images")
+
     def __init__(self, meta):
         self.id = meta["id"]
 
@@ -21,19 +29,13 @@ class Artwork:
 
         self.user = User(meta)
 
-        self.preview = OriginalArtworkImage(0, meta)
-
         self.nsfw_level = meta["x_restrict"]
         self.nsfw = self.nsfw_level > 0
 
-        self.tags = [ArtworkTag(x) for x in meta["tags"]]
         self.tools = meta["tools"]
         self.width = meta["width"]
         self.height = meta["height"]
 
-        self.post_date = datetime.strptime(meta["create_date"], "%Y-%m-%dT%H:%M:%S%z")
-        self.post_date_ago = timeago.format(self.post_date, now_tz())
-
         self.page_count = meta["page_count"]
 
         self.sanity_level = meta["sanity_level"]
@@ -45,41 +47,94 @@ class Artwork:
 
         self.meta = meta
 
-        if meta["meta_pages"]:
-            self.original_images = [OriginalArtworkImage(x, meta) for x in range(len(meta["meta_pages"]))]
-        else:
-            self.original_images = [OriginalArtworkImage(0, meta)]
+        # tags, dates and images are only built when they are first used
+        self._tags = None
+        self._post_date = None
+        self._original_images = None
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = [ArtworkTag(x) for x in self.meta["tags"]]
+        return self._tags
+
+    @property
+    def post_date(self):
+        if self._post_date is None:
+            self._post_date = datetime.strptime(self.meta["create_date"], "%Y-%m-%dT%H:%M:%S%z")
+        return self._post_date
+
+    @property
+    def post_date_ago(self):
+        # relative to the time of rendering, so it is never cached
+        import timeago
+        return timeago.format(self.post_date, now_tz())
+
+    @property
+    def original_images(self):
+        if self._original_images is None:
+            if self.meta["meta_pages"]:
+                self._original_images = [OriginalArtworkImage(x, self.meta)
+                                         for x in range(len(self.meta["meta_pages"]))]
+            else:
+                self._original_images = [OriginalArtworkImage(0, self.meta)]
+        return self._original_images
+
+    @property
+    def preview(self):
+        return self.original_images[0]
+
+    def fs_upload(self, direct=False):
+        # Uploads the images of every page at once, so remote backends can send them concurrently.
+        # With direct=True, the images were downloaded to the local storage already: pixiv.download_pipeline() only
+        # yields artworks whose every image was downloaded completely and renamed into place, they are only checked
+        for i in self.original_images:
+            for _, filename in i.fs_files():
+                source = storage.backend.local_path(self.id, filename) if direct \
+                    else Path(f"{conf['temp_path']}/{self.id}/{filename}")
+                assert source.exists()  # kill the import if download failure
+        if direct:
+            return [True for i in self.original_images for _ in i.fs_files()]
+        return storage.backend.upload_many([(self.id, filename, Path(f"{conf['temp_path']}/{self.id}/{filename}"))
+                                            for i in self.original_images for _, filename in i.fs_files()])
+
+    def fs_delete(self):
+        return storage.backend.delete_many([(self.id, filename)
+                                            for i in self.original_images for _, filename in i.fs_files()])
 
     @classmethod
     def from_id(cls, aid):
-        if str(aid) in artworks:
-            return cls(artworks[str(aid)])
+        aw = cache.get(str(aid))
+        if aw is not None:
+            return aw
+        meta = artworks.get(str(aid))
+        if meta is not None:
+            aw = cls(meta)
+            cache.put(str(aid), aw)
+            return aw
         return None
 
     @classmethod
-    def all(cls, limit=0, offset=0):
-        aws = list(artworks.keys())  # this allows to select only a subset of artworks
-        aws.reverse()
-        if not limit:
-            return [cls(artworks[a]) for a in aws]
-        return [cls(artworks[a]) for a in aws[offset:offset+limit]]
+    def all(cls, limit=0, offset=0, order="default"):
+        # the store index only returns the selected subset of ids, newest bookmarks (or artworks) first
+        return [cls.from_id(a) for a in artworks.ids(limit=limit, offset=offset, order=order)]
 
     @classmethod
-    def all_filtered(cls, limit=0, offset=0):
-        aws = [k for k, v in artworks.items() if v["x_restrict"] <= 0]  # filter artworks when creating keys list
-        aws.reverse()
-        if not limit:
-            return [cls(artworks[a]) for a in aws]
-        return [cls(artworks[a]) for a in aws[offset:offset+limit]]
+    def all_filtered(cls, limit=0, offset=0, order="default"):
+        return [cls.from_id(a) for a in artworks.ids(limit=limit, offset=offset, sfw=True, order=order)]
 
 
 class ArtworkTag:
+    __slots__ = ("name", "translated_name")
+
     def __init__(self, tag_meta):
         self.name = tag_meta["name"]
         self.translated_name = tag_meta["translated_name"]
 
 
 class OriginalArtworkImage:
+    __slots__ = ("original", "large", "medium", "square_medium", "id", "img", "_ext")
+
     def __init__(self, img, meta):
         if meta["meta_pages"]:
             self.original = meta["meta_pages"][img]["image_urls"]["original"]
@@ -93,61 +148,36 @@ class OriginalArtworkImage:
             self.square_medium = meta["image_urls"]["square_medium"]
         self.id = meta["id"]
         self.img = img
+        self._ext = None
+
+    @property
+    def ext(self):
         # the following image extension is only valid for the full size image, large/medium/square are always jpeg.
         # get_ext() will always return the correct extension using the code below, for the correct image quality
-        self.ext = str(parse.urlparse(self.original).path).split("/")[-1].split(".")[-1]
-
-    def fs_upload(self):
-        for x in ("original", "large", "medium", "square_medium"):
-            filename = f"{self.id}_p{self.img}_{x}.{self.get_ext(x)}"
-            assert Path(f"{conf['temp_path']}/{self.id}/{filename}").exists()  # kill the import if download failure
-        for x in ("original", "large", "medium", "square_medium"):
-            filename = f"{self.id}_p{self.img}_{x}.{self.get_ext(x)}"
-            source = Path(f"{conf['temp_path']}/{self.id}/{filename}")
-            if conf["filesystem"] == "local":
-                dest = Path(f"{conf['filesystem_options']['path']}/{self.id}/{filename}")
-                dest.parent.mkdir(exist_ok=True)
-                copyfile(source, dest)
-                print(f"copy: {self.id}/{filename}")
-            elif conf["filesystem"] == "remote":
-                with source.open('rb') as s:
-                    # the remote filesystem is only compatible with php-fs. if using ftp/sftp/rsync/whatever mount,
-                    # the user should use local and specify the path to the mount
-                    r = requests.post(f"{conf['filesystem_options']['server']}/upload",
-                                      headers={"Token": conf["filesystem_options"]["token"]},
-                                      data={"path": self.id, "file": filename},
-                                      files={"file": s})
-                    print(f"upload: {self.id}/{filename} - {int(r.elapsed.microseconds/1000)}ms {r.status_code}")
-                    if not r.ok:
-                        print(f"Upload failure for {self.id}/{filename}.")
+        if self._ext is None:
+            self._ext = self.get_ext("original")
+        return self._ext
 
-    def fs_delete(self):
-        for x in ("original", "large", "medium", "square_medium"):
-            filename = f"{self.id}_p{self.img}_{x}.{self.get_ext(x)}"
-            if conf["filesystem"] == "local":
-                target = Path(f"{conf['filesystem_options']['path']}/{self.id}/{filename}")
-                target.unlink(missing_ok=True)
-                print(f"delete: {self.id}/{filename}")
-            elif conf["filesystem"] == "remote":
-                r = requests.post(f"{conf['filesystem_options']['server']}/delete",
-                                  headers={"Token": conf["filesystem_options"]["token"]},
-                                  data={"path": self.id, "file": filename})
-                print(f"delete: {self.id}/{filename} - {int(r.elapsed.microseconds/1000)}ms {r.status_code}")
-                if not r.ok:
-                    print(f"Delete failure for {self.id}/{filename}.")
-
-    def fs_get(self, quality, force_proxy=False):
+    def fs_files(self):
+        # Filenames of every image quality stored for this page
+        return [(x, f"{self.id}_p{self.img}_{x}.{self.get_ext(x)}")
+                for x in ("original", "large", "medium", "square_medium")]
+
+    def fs_path(self, quality):
+        # Path of the image if using local storage, None otherwise
+        return storage.backend.local_path(self.id, f"{self.id}_p{self.img}_{quality}.{self.get_ext(quality)}")
+
+    def fs_get(self, quality, force_proxy=False, stream=False):
         assert quality in ("original", "large", "medium", "square_medium")
         filename = f"{self.id}_p{self.img}_{quality}.{self.get_ext(quality)}"
-        if conf["filesystem"] == "local":
-            return Path(f"{conf['filesystem_options']['path']}/{self.id}/{filename}").open('rb')
-        elif conf["filesystem"] == "remote":
-            url = f"{conf['filesystem_options']['server']}/{self.id}/{filename}"
-            if conf["filesystem_options"]["proxy"] or force_proxy:
-                r = requests.get(url)
-                return BytesIO(r.content)  # make it a readable file-like object
-            else:
-                return url
+        if storage.backend.redirect and not force_proxy:
+            return storage.backend.url(self.id, filename)
+        # read the body as it arrives (or from the local cache) instead of buffering it
+        obj = storage.backend.open(self.id, filename, quality)
+        if stream:
+            return obj
+        with obj:
+            return BytesIO(obj.read())  # make it a seekable file-like object
 
     def get_url(self, quality):
         assert quality in ("original", "large", "medium", "square_medium")
@@ -0,0 +1,37 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Thread-safe mapping keeping at most `size` entries, evicting the least recently used ones
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.data.clear()
+            else:
+                self.data.pop(key, None)
@@ -1,4 +1,6 @@
 class User:
+    __slots__ = ("id", "name", "account")
+
     def __init__(self, meta):
         self.id = meta["user"]["id"]
         self.name = meta["user"]["name"]
@@ -0,0 +1,141 @@
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+# Minimal PDF writer for exports: one image per page, sized like img2pdf does (from the image DPI, 96 by default).
+# Pages are written to the output as soon as they are read, and the cross-reference table is built from the offsets
+# written so far, so memory stays bounded by the largest page whatever the page count.
+# JPEG files are copied as-is (DCTDecode), like the image data of 8-bit, non-interlaced grayscale and RGB PNG files
+# (FlateDecode with the PNG predictors). Other images are decoded and compressed again, one page at a time.
+# Images with transparency must be flattened first, see imaging.flatten()
+
+CHUNK_SIZE = 65536
+DEFAULT_DPI = 96
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+COLORSPACES = {"L": ("DeviceGray", 1), "RGB": ("DeviceRGB", 3), "CMYK": ("DeviceCMYK", 4)}
+ROTATIONS = {3: 180, 6: 90, 8: 270}  # EXIF orientations that are a rotation of the page
+
+
+class PDFWriter:
+    def __init__(self, out):
+        self.out = out
+        self.pos = 0
+        self.offsets = {}  # object number -> offset
+        self.pages = []
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, b):
+        self.out.write(b)
+        self.pos += len(b)
+
+    def _object(self, num, body, stream=None, length=None):
+        # Writes an object, and its stream from bytes or a function writing length bytes
+        self.offsets[num] = self.pos
+        self._write(f"{num} 0 obj\n".encode() + body)
+        if stream is not None or length is not None:
+            self._write(b"\nstream\n")
+            if callable(stream):
+                start = self.pos
+                stream(self)
+                assert self.pos - start == length, "stream length mismatch"
+            else:
+                self._write(stream)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+
+    def add_image(self, path):
+        num = 3 + 3 * len(self.pages)  # 1 and 2 are the catalog and the page tree, written by close()
+        with Image.open(path) as im:
+            dpi = im.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+            width, height = im.size
+            rotate = ROTATIONS.get(im.getexif().get(0x0112), 0) if im.format == "JPEG" else 0
+            image = _passthrough(path, im) or _encoded(im)
+        body, stream, length = image
+        self._object(num, f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} ".encode() + body +
+                     f" /Length {length} >>".encode(), stream, length)
+        pw, ph = (width * 72 / (dpi[0] or DEFAULT_DPI), height * 72 / (dpi[1] or DEFAULT_DPI))
+        contents = f"q {pw:.4f} 0 0 {ph:.4f} 0 0 cm /Im0 Do Q".encode()
+        self._object(num + 1, f"<< /Length {len(contents)} >>".encode(), contents)
+        self._object(num + 2, (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw:.4f} {ph:.4f}] "
+                               f"/Resources << /XObject << /Im0 {num} 0 R >> >> /Contents {num + 1} 0 R"
+                               + (f" /Rotate {rotate}" if rotate else "") + " >>").encode())
+        self.pages.append(num + 2)
+
+    def close(self):
+        kids = " ".join(f"{p} 0 R" for p in self.pages)
+        self._object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        self._object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>".encode())
+        xref = self.pos
+        size = max(self.offsets) + 1
+        self._write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+        self._write(b"".join(b"%010d 00000 n \n" % self.offsets[n] for n in range(1, size)))
+        self._write(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def _copy(path, ranges):
+    # Stream writer copying the (offset, length) ranges of a file
+    def write(writer):
+        with open(path, "rb") as f:
+            for offset, length in ranges:
+                f.seek(offset)
+                while length:
+                    chunk = f.read(min(length, CHUNK_SIZE))
+                    if not chunk:
+                        raise OSError(f"{path} was truncated while it was read")
+                    writer._write(chunk)
+                    length -= len(chunk)
+    return write
+
+
+def _passthrough(path, im):
+    # (dictionary entries, stream writer, length) of the image data copied from the file, or None if it can't be
+    if im.format == "JPEG" and im.mode in COLORSPACES:
+        cs, _ = COLORSPACES[im.mode]
+        # Adobe CMYK JPEGs store inverted values
+        decode = " /Decode [1 0 1 0 1 0 1 0]" if im.mode == "CMYK" and "adobe" in im.info else ""
+        size = os.path.getsize(path)
+        return f"/ColorSpace /{cs} /BitsPerComponent 8 /Filter /DCTDecode{decode}".encode(), \
+            _copy(path, [(0, size)]), size
+    if im.format == "PNG" and im.mode in ("L", "RGB") and not im.info.get("interlace"):
+        ranges = _png_data(path)
+        if ranges is None:
+            return None
+        cs, colors = COLORSPACES[im.mode]
+        return (f"/ColorSpace /{cs} /BitsPerComponent 8 /Filter /FlateDecode /DecodeParms << /Predictor 15 "
+                f"/Colors {colors} /BitsPerComponent 8 /Columns {im.width} >>").encode(), \
+            _copy(path, ranges), sum(n for _, n in ranges)
+    return None
+
+
+def _png_data(path):
+    # (offset, length) of the IDAT chunks of an 8-bit PNG file, their concatenation is the zlib stream of the image
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        ranges = []
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, kind = struct.unpack(">I4s", header)
+            if kind == b"IHDR" and f.read(length)[8] != 8:
+                return None  # not 8 bits per sample
+            elif kind == b"IDAT":
+                ranges.append((f.tell(), length))
+                f.seek(length, 1)
+            elif kind == b"IEND":
+                return ranges
+            elif kind != b"IHDR":
+                f.seek(length, 1)
+            f.seek(4, 1)  # CRC
+
+
+def _encoded(im):
+    # Pixels decoded and compressed again, for the formats that can't be copied
+    if im.mode not in COLORSPACES:
+        im = im.convert("L" if im.mode in ("1", "I", "I;16", "F") else "RGB")
+    cs, _ = COLORSPACES[im.mode]
+    data = zlib.compress(im.tobytes())
+    return f"/ColorSpace /{cs} /BitsPerComponent 8 /Filter /FlateDecode".encode(), data, len(data)
@@ -1,48 +1,103 @@
-import requests
 from pathlib import Path
 from shutil import rmtree
+from collections import deque
+from time import time
 
 import pixivpy3
 from urllib import parse
 
-from pxyTools import JSONDict
-
-from utils import conf
+from shared import AtomicJSONDict
+from utils import conf, temp, artworks
+from downloader import Downloader
+import storage
+import metrics
 
 PATH = Path(conf["temp_path"])
+# With local storage, images are downloaded straight to their final location instead of being copied from temp_path
+DIRECT = conf.get("refresh", {}).get("direct_write", True) and storage.backend.local_path("", "") is not None
 
 app_api = pixivpy3.aapi.AppPixivAPI()
+downloader = Downloader(**conf.get("download", {}))
+
+
+def api_call(method, func, *args, **kwargs):
+    # Calls a pixiv API method, recording its latency and errors
+    with metrics.pixiv_api.time(method):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.pixiv_api_errors.inc(1, method)
+            raise
 
 
-def auth():
+def auth(api=None):
     # Authenticate with pixiv and get a new access/refresh token
-    login = app_api.auth(refresh_token=conf["pixiv"]["refresh"])
+    login = api_call("auth", (api or app_api).auth, refresh_token=conf["pixiv"]["refresh"])
     conf["pixiv"]["access"] = login["access_token"]
     conf["pixiv"]["refresh"] = login["refresh_token"]
     conf.save()
     return login
 
 
-def get_bookmarks():
-    login = auth()
+def full_sweep_due():
+    # A full sweep walks the whole bookmark list to update the metadata of every stored artwork
+    opts = conf.get("refresh", {})
+    if not opts.get("incremental", True):
+        return True
+    last = temp.get("sync", {}).get("last_full", 0)
+    return time() - last >= opts.get("full_sweep_days", 7) * 86400
+
+
+def get_bookmarks(full=True, api=None, on_page=None):
+    # With full=False, stops at the page containing the newest bookmark of the last sync, or at the first page
+    # whose bookmarks are all stored already, instead of walking the whole bookmark history.
+    # on_page is called with the number of bookmarks of every fetched page
+    api = api or app_api
+    login = auth(api)
+    sync = temp.get("sync", {})
+    cursor = None if full else sync.get("cursor")
     illustrations = []
     index = None
-    print("Fetching bookmarks...")
+    calls = 0
+    print("Fetching bookmarks..." if full else f"Fetching new bookmarks (last synced bookmark: {cursor})...")
     # pixiv bookmarks works with a max_bookmark_id, which acts as a "depth" in the bookmarks
     while True:
         print(f"current depth: {index}")
-        r = app_api.user_bookmarks_illust(login["user"]["id"], max_bookmark_id=index)  # query pixiv for bookmarks
+        r = api_call("user_bookmarks_illust", api.user_bookmarks_illust, login["user"]["id"],
+                     max_bookmark_id=index)  # query pixiv for bookmarks
+        calls += 1
         illustrations += r["illusts"]
+        if on_page:
+            on_page(len(r["illusts"]))
+        if not full and r["illusts"]:
+            ids = [i["id"] for i in r["illusts"]]
+            if cursor in ids or all(str(i) in artworks for i in ids):
+                break
         try:
             # noinspection PyTypeChecker
             index = parse.parse_qs(parse.urlparse(r["next_url"]).query)["max_bookmark_id"][0]  # get new depth value
-        except (IndexError, KeyError):
+        except (IndexError, KeyError, TypeError):
             break
-    print(f"Fetched {len(illustrations)} bookmarks.")
+    saved = max(sync.get("full_calls", calls) - calls, 0) if not full else 0
+    print(f"Fetched {len(illustrations)} bookmarks in {calls} API calls ({saved} calls saved).")
+    temp["sync"] = {**sync, "calls": calls, "saved_calls": saved}
+    if full:
+        temp["sync"]["full_calls"] = calls
     return illustrations
 
 
-def download_bookmarks(illustration):
+def commit_sync(illustrations, full):
+    # Only called once a refresh succeeded, so an interrupted refresh doesn't move the cursor past missing bookmarks
+    sync = temp.get("sync", {})
+    if illustrations:
+        sync["cursor"] = illustrations[0]["id"]
+    if full:
+        sync["last_full"] = int(time())
+    temp["sync"] = sync
+    temp.save()
+
+
+def download_queue(illustration):
     iid = illustration["id"]
     cur = 0
     queue = []
@@ -59,19 +114,93 @@ def download_bookmarks(illustration):
         queue.append((p["image_urls"]["medium"], f"{iid}_p{cur}_medium"))
         queue.append((p["image_urls"]["square_medium"], f"{iid}_p{cur}_square_medium"))
         cur += 1
-    mp = Path(f"{PATH}/{iid}")
-    mp.mkdir(exist_ok=True)
+    mp = storage.backend.local_path(iid, "") if DIRECT else Path(f"{PATH}/{iid}")
+    mp.mkdir(parents=True, exist_ok=True)
 
+    files = []
     for url, filename in queue:
         # Get the extension based of the end of the URL
         ext = str(parse.urlparse(url).path).split("/")[-1].split(".")[-1]
         # Setting the Referer header is mandatory for the pixivCDN
-        with requests.get(url, headers={'Referer': url}) as r:
-            if r.ok:
-                Path(f"{mp}/{filename}.{ext}").write_bytes(r.content)
-            print(f"queue: {mp}/{filename} - {len(r.content)}B in {int(r.elapsed.microseconds/1000)}ms ->"
-                  f" {r.status_code}")
-    JSONDict(f"{mp}/_meta.json", data=illustration).save()  # This isn't used anymore, but is still saved in case...
+        files.append((url, f"{mp}/{filename}.{ext}", {"Referer": url}))
+    return files
+
+
+def image_count(illustration):
+    # Number of images downloaded by download_queue: 4 qualities of every page
+    return 4 * max(len(illustration["meta_pages"]), 1)
+
+
+def download_bookmarks(illustration):
+    # All the images of the illustration are downloaded concurrently by the shared downloader pool
+    downloader.fetch_all(download_queue(illustration))
+    if not DIRECT:
+        mp = Path(f"{PATH}/{illustration['id']}")
+        # This isn't used anymore, but is still saved in case...
+        AtomicJSONDict(f"{mp}/_meta.json", data=illustration).save()
+
+
+def download_files(illustration, filenames):
+    # Downloads some of the images of an illustration again. Returns the (status, size, sha256) of every filename
+    queue = [q for q in download_queue(illustration) if Path(q[1]).name in filenames]
+    return {Path(q[1]).name: r for q, r in zip(queue, downloader.fetch_all(queue))}
+
+
+def download_pipeline(illustrations, window=8, on_image=None):
+    # Yields illustrations in order as soon as every one of their images was downloaded, while the images of the next
+    # `window` illustrations keep downloading. This bounds the temporary disk usage to `window` illustrations.
+    # on_image is called from the downloader threads with the path, status, size and sha256 of every downloaded image.
+    # A failed image stops the pipeline: the images of the illustrations that weren't yielded are removed, so direct
+    # downloads don't leave files of artworks that were never imported in the storage. Close the pipeline (with
+    # contextlib.closing) to remove them as soon as the caller stops too
+    pending = deque()
+    source = iter(illustrations)
+
+    def enqueue():
+        i = next(source, None)
+        if i is not None:
+            queue = download_queue(i)
+            futures = [downloader.submit(*q) for q in queue]
+            if on_image:
+                for q, f in zip(queue, futures):
+                    f.add_done_callback(lambda f, dest=q[1]: f.cancelled() or f.exception()
+                                        or on_image(dest, *f.result()))
+            pending.append((i, queue, futures))
+
+    try:
+        for _ in range(window):
+            enqueue()
+        while pending:
+            i, queue, futures = pending[0]
+            # The sha256 is only returned once the whole body was written and renamed to its destination
+            failed = [Path(q[1]).name for q, f in zip(queue, futures) if f.result()[2] is None]
+            if failed:
+                raise OSError(f"Download failure for {', '.join(failed)}.")
+            pending.popleft()
+            if not DIRECT:
+                AtomicJSONDict(f"{PATH}/{i['id']}/_meta.json", data=i).save()
+            enqueue()
+            yield i
+    finally:
+        for i, queue, futures in pending:
+            for f in futures:
+                f.cancel()
+            for f in futures:
+                if not f.cancelled():
+                    f.exception()  # waits for the download
+            _discard(i, queue)
+
+
+def _discard(illustration, queue):
+    # Removes the images downloaded for an illustration that won't be imported
+    if not DIRECT:
+        return download_cleanup(illustration)
+    for _, dest, _ in queue:
+        Path(dest).unlink(missing_ok=True)
+    try:
+        Path(queue[0][1]).parent.rmdir()
+    except OSError:
+        pass  # not empty
 
 
 def download_cleanup(illustration):
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from hashlib import sha1
+
+from utils import conf
+from disk_cache import DiskCache
+
+# Downscaled copies of the original images, requested as /i/<artwork>/<image>/w<width>. Only the configured widths
+# are rendered, so clients can't fill the cache with arbitrary sizes
+WIDTHS = tuple(conf.get("renditions", {}).get("widths", [240, 480, 720, 1080]))
+QUALITY = conf.get("renditions", {}).get("quality", 80)
+# Formats in order of preference, used if the client accepts them and Pillow can write them: (mimetype, format, ext)
+FORMATS = [f for f in (("image/avif", "AVIF", "avif"), ("image/webp", "WEBP", "webp"))
+           if f[2] in conf.get("renditions", {}).get("formats", ["avif", "webp"])]
+FALLBACK = ("image/jpeg", "JPEG", "jpg")
+_supported = None
+
+cache = DiskCache(f"{conf.get('cache', {}).get('path', './cache')}/renditions",
+                  conf.get("cache", {}).get("renditions", 1024 ** 3))
+
+
+def width(quality):
+    # Width of a rendition quality (w<width>), None if it isn't one
+    if quality and quality[0] == "w" and quality[1:].isdigit() and int(quality[1:]) in WIDTHS:
+        return int(quality[1:])
+    return None
+
+
+def supported():
+    # FORMATS Pillow can write, checked on first use so that Pillow isn't imported by processes never resizing images
+    global _supported
+    if _supported is None:
+        import imaging
+        _supported = [f for f in FORMATS if f[1] in imaging.save_formats()]
+    return _supported
+
+
+def negotiate(accept):
+    # Best format explicitly accepted by the client (browsers list image/avif and image/webp), JPEG otherwise.
+    # */* isn't enough, older clients send it without supporting these formats
+    accepted = {m for m, q in accept if q > 0}
+    return next((f for f in supported() if f[0] in accepted), FALLBACK)
+
+
+def key(img, w, fmt):
+    # The fingerprint changes with the image URL, so a rendition is never served for a replaced page
+    return f"{img.id}_p{img.img}_w{w}_{sha1(img.original.encode()).hexdigest()[:12]}.{fmt[2]}"
+
+
+class Renderer:
+    # Renders the missing renditions in a process pool. Concurrent requests for the same rendition wait for the
+    # first one to render it instead of rendering it again
+    def __init__(self, cache, workers=None):
+        self.cache = cache
+        self.workers = workers
+        self._pool = None
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> Future of the path of the rendition
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def get(self, img, w, fmt):
+        # Returns the path of the cached rendition, rendered if needed
+        k = key(img, w, fmt)
+        path = self.cache.get(k)
+        if path is not None:
+            return path
+        with self.lock:
+            running = self.pending.get(k)
+            if running is None:
+                future = self.pending[k] = Future()
+        if running is not None:
+            return running.result()
+        try:
+            path = self._render(img, w, fmt, k)
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[k]
+
+    def _render(self, img, w, fmt, k):
+        # Local originals are read by the worker, others are downloaded first
+        import imaging
+        source = img.fs_path("original")
+        source = str(source) if source is not None else img.fs_get("original", force_proxy=True).getvalue()
+        tmp = self.cache.tmp_path(k)
+        try:
+            self.pool.submit(imaging.render, source, str(tmp), w, fmt[1], QUALITY).result()
+            return self.cache.put(k, tmp)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+
+renderer = Renderer(cache, conf.get("renditions", {}).get("workers"))
@@ -0,0 +1,168 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils import conf, artworks
+from objects import Artwork
+import storage
+import files
+import renditions
+import jobs
+
+MISSING, EMPTY, SIZE, CHECKSUM = "missing", "empty", "size mismatch", "checksum mismatch"
+# Problems fixed by downloading the image again. Other errors (storage server unreachable...) are only reported
+REPAIRABLE = (MISSING, EMPTY, SIZE, CHECKSUM)
+
+
+class FileIndex:
+    # Size and sha256 of the stored images, recorded when they are downloaded, in a separate SQLite database.
+    # Images stored before checksums were recorded get theirs the first time they are scrubbed
+    def __init__(self, path, store):
+        self.path = Path(path)
+        self.store = store
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER,
+                    sha256 TEXT,
+                    PRIMARY KEY (id, filename)
+                )
+            """)
+            self.db.commit()
+
+    def update(self, aid):
+        # Store listener, forgets the images of deleted artworks
+        if str(aid) not in self.store:
+            with self.lock:
+                self.db.execute("DELETE FROM files WHERE id = ?", (int(aid),))
+                self.db.commit()
+
+    def record(self, aid, rows):
+        # rows are (filename, size, sha256)
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO files (id, filename, size, sha256) VALUES (?, ?, ?, ?)",
+                                [(int(aid), *r) for r in rows])
+            self.db.commit()
+
+    def get_many(self, aids):
+        # (id, filename) -> (size, sha256) of the images of the given artworks
+        with self.lock:
+            rows = self.db.execute(f"SELECT id, filename, size, sha256 FROM files WHERE id IN "
+                                   f"({', '.join('?' * len(aids))})", [int(a) for a in aids]).fetchall()
+        return {(aid, filename): (size, sha256) for aid, filename, size, sha256 in rows}
+
+
+index = FileIndex(conf.get("scrub", {}).get("path", "files.db"), artworks)
+artworks.listeners.append(index.update)
+
+
+def verify(aid, filename, known, checksums=False):
+    # Returns the problem found (None if the image is fine), and the size and sha256 (if it was read) of the image
+    try:
+        if checksums:
+            size, digest = storage.backend.digest(aid, filename)
+        else:
+            size, digest = storage.backend.stat(aid, filename), None
+    except FileNotFoundError:
+        return MISSING, None, None
+    except Exception as e:
+        return f"error ({type(e).__name__}: {e})", None, None
+    if size == 0:
+        return EMPTY, size, digest
+    if known and known[0] is not None and size is not None and size != known[0]:
+        return SIZE, size, digest
+    if known and known[1] and digest and digest != known[1]:
+        return CHECKSUM, size, digest
+    return None, size, digest
+
+
+def repair(aw, filenames):
+    # Downloads the broken images again from pixiv and stores them like a refresh does. Returns the repaired filenames
+    import pixiv
+    results = pixiv.download_files(aw.meta, filenames)
+    done = [(name, size, digest) for name, (_, size, digest) in results.items() if digest is not None]
+    if not pixiv.DIRECT:
+        stored = storage.backend.upload_many([(aw.id, name, pixiv.PATH / str(aw.id) / name) for name, _, _ in done])
+        done = [d for d, ok in zip(done, stored) if ok]
+        pixiv.download_cleanup(aw.meta)
+    for name, _, _ in done:
+        storage.backend.invalidate(aw.id, name)
+    files.exports.invalidate(f"{aw.id}_")
+    files.flattened.invalidate(f"{aw.id}_")
+    renditions.cache.invalidate(f"{aw.id}_")
+    index.record(aw.id, done)
+    return [name for name, _, _ in done]
+
+
+@jobs.queue.handler("scrub")
+def scrub(job, checksums=False):
+    # Verifies the images of every artwork in bookmark order, scrub.workers at a time, and downloads the broken ones
+    # again. The position and counts are saved after every batch, so an interrupted scrub resumes where it stopped
+    opts = conf.get("scrub", {})
+    batch = opts.get("batch", 100)
+    counts = {"images": 0, "problems": 0, "repaired": 0, **job.checkpoint.get("counts", {})}
+    entries = sorted((e[0], aid) for aid, e in artworks.index.entries.items() if e[0] > job.checkpoint.get("seq", 0))
+    print(f"Scrubbing {len(entries)} artworks{' with checksums' if checksums else ''}...")
+    start = time.monotonic()
+    job.stage("artworks", len(entries))
+    job.stage("images")
+    job.stage("repair")
+
+    def check(item):
+        aw, name, known = item
+        problem, size, digest = verify(aw.id, name, known, checksums)
+        job.advance("images", 1, (size or 0) if checksums else 0)  # bytes read
+        return problem, size, digest
+
+    with ThreadPoolExecutor(max_workers=opts.get("workers", 8), thread_name_prefix="scrub") as pool:
+        for n in range(0, len(entries), batch):
+            chunk = entries[n:n + batch]
+            aws = [aw for aw in (Artwork.from_id(aid) for _, aid in chunk) if aw is not None]
+            known = index.get_many([aw.id for aw in aws])
+            items = [(aw, name, known.get((aw.id, name)))
+                     for aw in aws for i in aw.original_images for _, name in i.fs_files()]
+            broken = {}
+            new = {}
+            for (aw, name, k), (problem, size, digest) in zip(items, pool.map(check, items)):
+                if problem:
+                    print(f"scrub: {aw.id}/{name} -> {problem}")
+                    counts["problems"] += 1
+                    if problem in REPAIRABLE:
+                        broken.setdefault(aw, []).append(name)
+                elif k is None or (digest and not k[1]):
+                    new.setdefault(aw.id, []).append((name, size, digest))
+            for aid, rows in new.items():
+                index.record(aid, rows)
+            for aw, names in broken.items():
+                repaired = repair(aw, names)
+                job.advance("repair", len(repaired))
+                counts["repaired"] += len(repaired)
+                for name in set(names) - set(repaired):
+                    print(f"scrub: {aw.id}/{name} -> could not be downloaded again")
+            counts["images"] += len(items)
+            job.advance("artworks", len(chunk))
+            job.save(seq=chunk[-1][0], counts=counts)
+    elapsed = max(time.monotonic() - start, 1e-3)
+    print(f"Scrubbed {counts['images']} images in {elapsed:.1f}s ({job.stages['images']['done'] / elapsed:.1f} "
+          f"images/s): {counts['problems']} problems, {counts['repaired']} images downloaded again.")
+
+
+if __name__ == '__main__':
+    import sys
+    # Usage: python scrub.py [--checksums]
+    # Queues a scrub and waits for it, it is run by this process unless the app is running another job
+    jid = jobs.queue.submit("scrub", checksums="--checksums" in sys.argv)
+    if jid is None:
+        sys.exit("A scrub is already queued or running.")
+    while (state := jobs.queue.get(jid))["state"] in ("queued", "running"):
+        time.sleep(5)
+        print(" | ".join(f"{s['name']}: {s['done']}{'/' + str(s['total']) if s['total'] is not None else ''} "
+                         f"({s['rate']:.1f}/s)" for s in state["stages"]))
+    print(f"Scrub {state['state']}{': ' + state['error'] if state['error'] else ''}")
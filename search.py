@@ -0,0 +1,218 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+import jobs
+from utils import conf, artworks, write_lock
+
+SCHEMA_VERSION = 1
+HTML_TAG = re.compile(r"<[^>]+>")
+# bm25 weights of the title, caption, tags, user and tools columns
+WEIGHTS = (10.0, 1.0, 5.0, 3.0, 1.0)
+ORDERS = {
+    "relevance": "bm25(docs_fts, {}, {}, {}, {}, {}), docs.seq DESC".format(*WEIGHTS),
+    "default": "docs.seq DESC",
+    "artwork": "docs.create_date DESC, docs.seq DESC",
+}
+
+
+def document(meta):
+    # Text of each indexed column. Captions are HTML, only their text is indexed
+    tags = " ".join(t["name"] + (f" {t['translated_name']}" if t["translated_name"] else "") for t in meta["tags"])
+    return (meta["title"], HTML_TAG.sub(" ", meta["caption"] or ""), tags,
+            f"{meta['user']['name']} {meta['user']['account']}", " ".join(meta["tools"]))
+
+
+class SearchIndex:
+    # Full-text index of the store in a separate SQLite database, using FTS5 with the trigram tokenizer so
+    # substrings of Japanese titles and tags can be found. It is kept up to date by the store listeners, and only
+    # rebuilt when it doesn't match the store anymore (first run, or the store was modified while the app was stopped)
+    def __init__(self, path, store):
+        self.path = Path(path)
+        self.store = store
+        self.lock = threading.RLock()
+        self.checked = False
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock:
+            # The index can be rebuilt from the store at any time, losing the last writes on a crash is fine
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.db.executescript("""
+                    DROP TABLE IF EXISTS docs;
+                    DROP TABLE IF EXISTS tags;
+                    DROP TABLE IF EXISTS docs_fts;
+                """)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    id INTEGER PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    create_date INTEGER NOT NULL,
+                    x_restrict INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    user_name TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS docs_seq ON docs (seq);
+                CREATE INDEX IF NOT EXISTS docs_user_id ON docs (user_id);
+                CREATE TABLE IF NOT EXISTS tags (
+                    id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    x_restrict INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tags_id ON tags (id);
+                CREATE INDEX IF NOT EXISTS tags_name ON tags (name, x_restrict, id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(title, caption, tags, user, tools,
+                                                                       tokenize = 'trigram');
+            """)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.db.commit()
+
+    def _remove(self, aid):
+        self.db.execute("DELETE FROM docs WHERE id = ?", (aid,))
+        self.db.execute("DELETE FROM tags WHERE id = ?", (aid,))
+        self.db.execute("DELETE FROM docs_fts WHERE rowid = ?", (aid,))
+
+    @staticmethod
+    def _rows(aid, meta, seq, create_date):
+        # Rows of the docs, tags and docs_fts tables for an artwork
+        return ((aid, seq, create_date, meta["x_restrict"], meta["user"]["id"], meta["user"]["name"]),
+                [(aid, t, meta["x_restrict"]) for t in {t["name"] for t in meta["tags"]}],
+                (aid, *document(meta)))
+
+    def _insert(self, docs, tags, texts):
+        self.db.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?)", docs)
+        self.db.executemany("INSERT INTO tags VALUES (?, ?, ?)", tags)
+        self.db.executemany("INSERT INTO docs_fts (rowid, title, caption, tags, user, tools) VALUES (?, ?, ?, ?, ?, ?)",
+                            texts)
+
+    def update(self, aid):
+        # Store listener, called with the id of every added, updated or removed artwork. The changes are committed
+        # along with the store's, by commit()
+        meta = self.store.get(str(aid))
+        with self.lock:
+            self._remove(int(aid))
+            if meta is not None:
+                seq, create_date = self.store.index.entries[str(aid)][:2]
+                doc, tags, text = self._rows(int(aid), meta, seq, create_date)
+                self._insert([doc], tags, [text])
+
+    def commit(self):
+        # Store save listener
+        with self.lock:
+            self.db.commit()
+
+    def rebuild(self):
+        with self.lock:
+            entries = self.store.index.entries
+            self.db.execute("DELETE FROM docs")
+            self.db.execute("DELETE FROM tags")
+            self.db.execute("DELETE FROM docs_fts")
+            docs, tags, texts = [], [], []
+            for aid, meta in self.store.items():
+                doc, t, text = self._rows(int(aid), meta, *entries[aid][:2])
+                docs.append(doc)
+                tags += t
+                texts.append(text)
+            texts.sort()  # FTS5 builds its doclists much faster when rows are inserted in rowid order
+            self._insert(docs, tags, texts)
+            self.db.execute("INSERT INTO docs_fts (docs_fts) VALUES ('optimize')")
+            self.db.commit()
+            self.checked = True
+        print(f"Indexed {len(entries)} artworks for search.")
+
+    def check(self):
+        # Cheap consistency check against the store, done once before the first search
+        with self.lock:
+            if self.checked:
+                return
+            index = self.store.index
+            expected = (len(index.entries), index.last_seq())
+            if self.db.execute("SELECT COUNT(*), MAX(seq) FROM docs").fetchone() != expected:
+                if not write_lock.acquire():
+                    return  # a worker is writing to the store, the index is checked again on the next search
+                try:
+                    self.rebuild()
+                finally:
+                    write_lock.release()
+                    # Jobs submitted during the rebuild couldn't start the executor, the lock being held
+                    jobs.queue.start()
+            self.checked = True
+
+    @staticmethod
+    def _filters(query, tag, user, x_restrict, sfw):
+        # Returns the joins, conditions and parameters selecting the matching artworks.
+        # Every word must match. Trigrams can't match words shorter than 3 characters, these are searched with instr
+        joins, where, params = [], [], []
+        words = query.lower().split()
+        long = [w for w in words if len(w) >= 3]
+        if long:
+            joins.append("JOIN docs_fts ON docs_fts.rowid = docs.id AND docs_fts MATCH ?")
+            params.append(" ".join('"' + w.replace('"', '""') + '"' for w in long))
+        for w in words:
+            if len(w) < 3:
+                where.append("docs.id IN (SELECT rowid FROM docs_fts WHERE instr(lower(title || ' ' || caption || ' ' "
+                             "|| tags || ' ' || user || ' ' || tools), ?) > 0)")
+                params.append(w)
+        if tag:
+            where.append("docs.id IN (SELECT id FROM tags WHERE name = ?)")
+            params.append(tag)
+        if user is not None:
+            where.append("docs.user_id = ?")
+            params.append(int(user))
+        if x_restrict is not None:
+            where.append("docs.x_restrict = ?")
+            params.append(int(x_restrict))
+        if sfw:
+            where.append("docs.x_restrict <= 0")
+        return " ".join(joins), (" WHERE " + " AND ".join(where)) if where else "", params
+
+    def search(self, query="", tag=None, user=None, x_restrict=None, sfw=False, limit=0, offset=0, order="relevance"):
+        # Returns the ids of a page of matching artworks, and the total number of matches
+        self.check()
+        joins, where, params = self._filters(query, tag, user, x_restrict, sfw)
+        if order not in ORDERS or (order == "relevance" and not joins):
+            order = "default"  # relevance can only be computed for full-text matches
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM docs {joins}{where}", params).fetchone()[0]
+            ids = [str(r[0]) for r in self.db.execute(
+                f"SELECT docs.id FROM docs {joins}{where} ORDER BY {ORDERS[order]} LIMIT ? OFFSET ?",
+                params + [limit or -1, offset])]
+        return ids, total
+
+    def facets(self, query="", tag=None, user=None, x_restrict=None, sfw=False, size=20):
+        # Most common tags and users among the matching artworks, and the number of matches per x_restrict
+        self.check()
+        joins, where, params = self._filters(query, tag, user, x_restrict, sfw)
+        matches = f"SELECT docs.id, docs.user_id, docs.user_name, docs.x_restrict FROM docs {joins}{where}"
+        with self.lock:
+            if not query.split() and not tag and user is None:
+                # Only filtered by rating, which is also stored in the tags table, so artworks don't need to be joined
+                _, where, params_tags = self._filters("", None, None, x_restrict, sfw)
+                tags = self.db.execute(f"""
+                    SELECT name, COUNT(*) AS c FROM tags {where.replace("docs.", "tags.")}
+                    GROUP BY name ORDER BY c DESC, name LIMIT ?
+                """, params_tags + [size]).fetchall()
+            else:
+                tags = self.db.execute(f"""
+                    WITH m AS ({matches}) SELECT tags.name, COUNT(*) AS c FROM m JOIN tags ON tags.id = m.id
+                    GROUP BY tags.name ORDER BY c DESC, tags.name LIMIT ?
+                """, params + [size]).fetchall()
+            users = self.db.execute(f"""
+                WITH m AS ({matches}) SELECT user_id, MAX(user_name), COUNT(*) AS c FROM m
+                GROUP BY user_id ORDER BY c DESC, user_id LIMIT ?
+            """, params + [size]).fetchall()
+            restrict = self.db.execute(f"""
+                WITH m AS ({matches}) SELECT x_restrict, COUNT(*) FROM m GROUP BY x_restrict ORDER BY x_restrict
+            """, params).fetchall()
+        return {"tags": tags, "users": users, "x_restrict": restrict}
+
+
+index = SearchIndex(conf.get("search", {}).get("path", "search.db"), artworks)
+artworks.listeners.append(index.update)
+artworks.save_listeners.append(index.commit)
+
+
+if __name__ == '__main__':
+    # Usage: python search.py, rebuilds the search index from the store
+    index.rebuild()
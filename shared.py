@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app can only run as a single process
+    fcntl = None
+
+# State shared by the worker processes of the app: JSON files written atomically, and locks held across processes
+
+
+class AtomicJSONDict(dict):
+    # Dict saved to a JSON file, written to a temporary file then renamed over the original, so a reader (or another
+    # worker) never sees a partially written file. sync() reloads the file when another process replaced it
+    def __init__(self, path, encoding="utf-8", data=None):
+        self.path = Path(path)
+        self.encoding = encoding
+        super().__init__(data or (self.load() if self.path.is_file() else {}))
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def save(self):
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, encoding=self.encoding, mode="w") as f:
+                json.dump(self, f, indent=4, separators=(',', ': '))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+        self.mtime = self._mtime()
+
+    def load(self):
+        # Returns the content of the file, without changing this dict
+        with open(self.path, encoding=self.encoding, mode="r") as f:
+            return json.load(f)
+
+    def sync(self):
+        # Returns whether the file was changed by another process and reloaded
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return False
+        data = self.load()
+        dict.clear(self)
+        dict.update(self, data)
+        self.mtime = mtime
+        return True
+
+
+class FileLock:
+    # Non-blocking lock shared by every process (and thread) of the app, using a POSIX lock on a lock file.
+    # The lock is released when the process ends, so a crashed worker never leaves a stale lock behind. Unlike flock,
+    # it isn't inherited by the processes forked while it's held (hashing and export pools)
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.f = None
+
+    def acquire(self):
+        # Returns whether the lock was acquired
+        if not self.lock.acquire(blocking=False):
+            return False
+        f = open(self.path, "a+")
+        if fcntl is not None:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                self.lock.release()
+                return False
+        self.f = f
+        return True
+
+    def release(self):
+        self.f.close()
+        self.f = None
+        self.lock.release()
+
+    def locked(self):
+        if not self.acquire():
+            return True
+        self.release()
+        return False
@@ -0,0 +1,442 @@
+import mmap
+import os
+import sqlite3
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+from json import dumps, loads
+from pathlib import Path
+
+from store import ArtworkIndex
+
+# Compact snapshot of the metadata store for read-only deployments, written after every refresh and mapped in memory
+# by the workers: its pages are read from the OS page cache and shared by every process, instead of each one keeping
+# its own index and artworks. The file is a JSON header followed by arrays:
+# - columns of every artwork in bookmark order (id, seq, date, x_restrict, page count, user)
+# - a table of interned strings (tags and user names), referenced by the tags and users tables
+# - blobs of titles, captions, image URLs and the other fields (as JSON), with their offsets
+# - the positions of the artworks sorted by date, without NSFW, and of every tag and user, with their rankings
+MAGIC = b"PBES"
+FORMAT = 1
+ALIGN = 8
+NONE = 0xFFFFFFFF  # string reference of a missing translated tag name
+
+IMAGE_URLS = ("square_medium", "medium", "large")
+PAGE_URLS = ("square_medium", "medium", "large", "original")
+# Fields stored in columns, replaced by 0 in the JSON of the other fields so that the key order is kept
+SPLIT = ("id", "title", "caption", "create_date", "x_restrict", "page_count", "tags", "image_urls",
+         "meta_single_page", "meta_pages")
+USER_SPLIT = ("id", "name", "account")
+
+
+def _split(meta):
+    # (other fields, title, caption, URLs) of an artwork, or None if it isn't shaped like usual pixiv metadata
+    try:
+        urls = [meta["image_urls"][q] for q in IMAGE_URLS] + [meta["meta_single_page"].get("original_image_url", "")]
+        for page in meta["meta_pages"]:
+            urls += [page["image_urls"][q] for q in PAGE_URLS]
+        extra = {**meta, **dict.fromkeys(SPLIT, 0), "user": {**meta["user"], **dict.fromkeys(USER_SPLIT, 0)}}
+        return (dumps(extra, ensure_ascii=False, separators=(",", ":")).encode(), meta["title"].encode(),
+                meta["caption"].encode(), "\n".join(urls).encode())
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def _join(aid, extra, title, caption, urls, date, tz, x_restrict, page_count, user, tags):
+    meta = loads(extra)
+    if meta["id"]:
+        return meta  # stored whole, see _split
+    urls = urls.split("\n")
+    meta.update(id=aid, title=title, caption=caption,
+                create_date=datetime.fromtimestamp(date, timezone(timedelta(minutes=tz))).isoformat(),
+                x_restrict=x_restrict, page_count=page_count, tags=[{"name": n, "translated_name": t} for n, t in tags],
+                image_urls=dict(zip(IMAGE_URLS, urls)),
+                meta_single_page={"original_image_url": urls[3]} if urls[3] else {},
+                meta_pages=[{"image_urls": dict(zip(PAGE_URLS, urls[i:i + 4]))} for i in range(4, len(urls), 4)])
+    meta["user"].update(zip(USER_SPLIT, user))
+    return meta
+
+
+class _Blob:
+    # Strings appended one after another, and their offsets
+    def __init__(self):
+        self.offsets = array("Q", [0])
+        self.data = bytearray()
+
+    def add(self, b):
+        self.data += b
+        self.offsets.append(len(self.data))
+
+
+def write(db_path, path):
+    # Writes the snapshot of a SQLite store to path, replacing the previous one atomically. Returns the artwork count
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        db.execute("BEGIN")  # the artworks and the version are read from the same snapshot of the database
+        version = db.execute("SELECT COALESCE(MAX(version), 0) FROM changes").fetchone()[0]
+        s = {name: array(code) for name, code in (
+            ("id", "q"), ("seq", "q"), ("date", "q"), ("tz", "h"), ("x_restrict", "b"), ("page_count", "i"),
+            ("user", "I"), ("tag_offsets", "Q"), ("tags", "I"), ("user_id", "q"), ("user_name", "I"),
+            ("user_account", "I"), ("sfw", "I"))}
+        s["tag_offsets"].append(0)
+        blobs = {name: _Blob() for name in ("strings", "title", "caption", "urls", "extra")}
+        strings, users, groups = {}, {}, {"tag": {}, "user": {}}
+
+        def intern(value):
+            if value not in strings:
+                strings[value] = len(strings)
+                blobs["strings"].add(value.encode())
+            return strings[value]
+
+        for p, (seq, aid, raw) in enumerate(db.execute("SELECT seq, id, meta FROM artworks ORDER BY seq")):
+            meta = loads(raw)
+            created = datetime.strptime(meta["create_date"], "%Y-%m-%dT%H:%M:%S%z")
+            user = (meta["user"]["id"], meta["user"]["name"], meta["user"]["account"])
+            if user not in users:
+                users[user] = len(users)
+                s["user_id"].append(user[0])
+                s["user_name"].append(intern(user[1]))
+                s["user_account"].append(intern(user[2]))
+            for name, value in (("id", aid), ("seq", seq), ("date", int(created.timestamp())),
+                                ("tz", int(created.utcoffset().total_seconds()) // 60),
+                                ("x_restrict", meta["x_restrict"]), ("page_count", meta["page_count"]),
+                                ("user", users[user])):
+                s[name].append(value)
+            for t in meta["tags"]:
+                s["tags"].extend((intern(t["name"]), NONE if t["translated_name"] is None
+                                  else intern(t["translated_name"])))
+            s["tag_offsets"].append(len(s["tags"]) // 2)
+            parts = _split(meta)
+            if parts is None or _join(aid, *(b.decode() for b in parts), s["date"][-1], s["tz"][-1],
+                                      meta["x_restrict"], meta["page_count"], user,
+                                      [(t["name"], t["translated_name"]) for t in meta["tags"]]) != meta:
+                parts = (raw.encode(), b"", b"", b"")
+            for name, b in zip(("extra", "title", "caption", "urls"), parts):
+                blobs[name].add(b)
+            sfw = meta["x_restrict"] <= 0
+            if sfw:
+                s["sfw"].append(p)
+            for kind, key in [("tag", t) for t in {t["name"] for t in meta["tags"]}] + [("user", user[0])]:
+                groups[kind].setdefault(key, ([], []))[0].append(p)
+                if sfw:
+                    groups[kind][key][1].append(p)
+    finally:
+        db.close()
+
+    n = len(s["id"])
+    by_date = sorted(range(n), key=lambda p: (s["date"][p], s["seq"][p]))
+    s["by_date"] = array("I", by_date)
+    s["by_date_sfw"] = array("I", (p for p in by_date if s["x_restrict"][p] <= 0))
+    order = sorted(range(n), key=s["id"].__getitem__)
+    s["id_sorted"] = array("q", (s["id"][p] for p in order))
+    s["id_position"] = array("I", order)
+    for kind, found in groups.items():
+        keys = sorted(found)
+        s[f"by_{kind}_keys"] = array("I", (intern(k) for k in keys)) if kind == "tag" else array("q", keys)
+        for suffix, i in (("", 0), ("_sfw", 1)):
+            offsets, postings = array("Q", [0]), array("I")
+            for k in keys:
+                postings.extend(found[k][i])
+                offsets.append(len(postings))
+            s[f"by_{kind}{suffix}_offsets"] = offsets
+            s[f"by_{kind}{suffix}_postings"] = postings
+            # Largest groups first, like ArtworkIndex.top()
+            s[f"by_{kind}{suffix}_top"] = array("I", sorted((g for g, k in enumerate(keys) if found[k][i]),
+                                                         key=lambda g: (-len(found[keys[g]][i]), str(keys[g]))))
+    for name, blob in blobs.items():
+        s[f"{name}_offsets"] = blob.offsets
+        s[name] = array("B", blob.data)
+
+    header = {"format": FORMAT, "byteorder": sys.byteorder, "version": version, "count": n, "sections": {}}
+    offset = 0
+    for name, a in s.items():
+        header["sections"][name] = (a.typecode, offset, len(a))
+        offset += -(-len(a) * a.itemsize // ALIGN) * ALIGN
+    head = dumps(header).encode()
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + len(head).to_bytes(4, "little") + head)
+        f.write(bytes(-f.tell() % ALIGN))
+        for a in s.values():
+            f.write(a.tobytes())
+            f.write(bytes(-f.tell() % ALIGN))
+    os.replace(tmp, path)
+    return n
+
+
+class _Strings:
+    # Sequence of the strings of a blob, decoded when read
+    def __init__(self, offsets, data, refs=None):
+        self.offsets = offsets
+        self.data = data
+        self.refs = refs  # indexes of the strings in the sequence, if it's a subset of the blob
+
+    def __len__(self):
+        return len(self.refs) if self.refs is not None else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.refs is not None:
+            i = self.refs[i]
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+
+class _Entries(Mapping):
+    # Read-only view of the artworks like ArtworkIndex.entries: id -> (seq, create_date, sfw, user id, tags)
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, aid):
+        p = self.snapshot.position(aid)
+        if p is None:
+            raise KeyError(aid)
+        return self.snapshot.entry(p)
+
+    def __iter__(self):
+        return (str(aid) for aid in self.snapshot.id)
+
+    def __len__(self):
+        return self.snapshot.count()
+
+
+class Snapshot:
+    # Snapshot file mapped in memory, answering the queries of ArtworkIndex and reading artworks without copying the
+    # arrays: only the strings of the artworks being read are decoded
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if bytes(view[:4]) != MAGIC:
+            raise ValueError(f"{path} isn't a metadata snapshot")
+        size = int.from_bytes(view[4:8], "little")
+        header = loads(bytes(view[8:8 + size]))
+        if header["format"] != FORMAT or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written by another version or on another architecture")
+        self.version = header["version"]
+        start = -(-(8 + size) // ALIGN) * ALIGN
+        s = {}
+        for name, (code, offset, length) in header["sections"].items():
+            s[name] = view[start + offset:start + offset + length * array(code).itemsize].cast(code)
+        self.s = s
+        self.id = s["id"]
+        self.strings = _Strings(s["strings_offsets"], s["strings"])
+        self.blobs = {name: _Strings(s[f"{name}_offsets"], s[name]) for name in ("title", "caption", "urls", "extra")}
+        self.group_keys = {"tag": _Strings(s["strings_offsets"], s["strings"], s["by_tag_keys"]),
+                           "user": s["by_user_keys"]}
+        self.entries = _Entries(self)
+
+    def position(self, aid):
+        try:
+            key = int(aid)
+        except (TypeError, ValueError):
+            return None
+        i = bisect_left(self.s["id_sorted"], key)
+        if i < len(self.id) and self.s["id_sorted"][i] == key:
+            return self.s["id_position"][i]
+        return None
+
+    def _tags(self, p):
+        tags = self.s["tags"]
+        return [(self.strings[tags[i]], None if tags[i + 1] == NONE else self.strings[tags[i + 1]])
+                for i in range(self.s["tag_offsets"][p] * 2, self.s["tag_offsets"][p + 1] * 2, 2)]
+
+    def entry(self, p):
+        s = self.s
+        return (s["seq"][p], s["date"][p], s["x_restrict"][p] <= 0, s["user_id"][s["user"][p]],
+                tuple(sorted({n for n, _ in self._tags(p)})))
+
+    def meta(self, p):
+        s = self.s
+        u = s["user"][p]
+        return _join(s["id"][p], *(self.blobs[name][p] for name in ("extra", "title", "caption", "urls")),
+                     s["date"][p], s["tz"][p], s["x_restrict"][p], s["page_count"][p],
+                     (s["user_id"][u], self.strings[s["user_name"][u]], self.strings[s["user_account"][u]]),
+                     self._tags(p))
+
+    def get(self, aid, default=None):
+        p = self.position(aid)
+        return self.meta(p) if p is not None else default
+
+    def __contains__(self, aid):
+        return self.position(aid) is not None
+
+    def keys(self):
+        return [str(aid) for aid in self.id]
+
+    def values(self):
+        return [self.meta(p) for p in range(len(self.id))]
+
+    def items(self):
+        return [(str(self.id[p]), self.meta(p)) for p in range(len(self.id))]
+
+    def count(self, sfw=False):
+        return len(self.s["sfw"]) if sfw else len(self.id)
+
+    def last_seq(self):
+        return self.s["seq"][-1] if len(self.id) else None
+
+    def ids(self, limit=0, offset=0, sfw=False, order="default"):
+        if order == "artwork":
+            lst = self.s["by_date_sfw" if sfw else "by_date"]
+        else:
+            lst = self.s["sfw"] if sfw else range(len(self.id))
+        return [str(self.id[p]) for p in ArtworkIndex._page(lst, limit, offset)]
+
+    def _group(self, kind, key, sfw):
+        # Positions of the artworks of a group, in bookmark order
+        keys = self.group_keys[kind]
+        if kind == "user":
+            try:
+                key = int(key)
+            except (TypeError, ValueError):
+                return ()
+        elif not isinstance(key, str):
+            return ()
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return ()
+        offsets = self.s[f"by_{kind}{'_sfw' if sfw else ''}_offsets"]
+        return self.s[f"by_{kind}{'_sfw' if sfw else ''}_postings"][offsets[i]:offsets[i + 1]]
+
+    def group_count(self, kind, key, sfw=False):
+        return len(self._group(kind, key, sfw))
+
+    def group_ids(self, kind, key, limit=0, offset=0, sfw=False):
+        return [str(self.id[p]) for p in ArtworkIndex._page(self._group(kind, key, sfw), limit, offset)]
+
+    def top(self, kind, limit=0, sfw=False):
+        suffix = "_sfw" if sfw else ""
+        ranking = self.s[f"by_{kind}{suffix}_top"]
+        offsets = self.s[f"by_{kind}{suffix}_offsets"]
+        return [(self.group_keys[kind][g], offsets[g + 1] - offsets[g])
+                for g in (ranking[:limit] if limit else ranking)]
+
+
+class SnapshotStore:
+    # Store of read-only deployments. Pages are served from the snapshot, shared by every worker, and the changes
+    # (refreshes and deletions) are written to the SQLite store then published as a new snapshot once done. Until
+    # then, the worker making them reads the SQLite store, and the other workers keep serving the previous snapshot
+    def __init__(self, store, path):
+        self.store = store
+        self.path = Path(path)
+        self.listeners = store.listeners
+        self.remote_listeners = store.remote_listeners
+        self.save_listeners = store.save_listeners
+        self.snapshot = None
+        self.stat = None
+        self.dirty = False  # changed by this process since the snapshot was written
+        self._load()
+
+    def _load(self):
+        # Maps the snapshot again if it was replaced, returns whether it was
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) == self.stat:
+            return False
+        self.stat = (stat.st_ino, stat.st_mtime_ns)
+        try:
+            self.snapshot = Snapshot(self.path)
+        except (ValueError, KeyError) as e:
+            print(f"Ignoring metadata snapshot: {e}")
+            self.snapshot = None
+        return True
+
+    @property
+    def reader(self):
+        snapshot = self.snapshot
+        return snapshot if snapshot is not None and not self.dirty else self.store
+
+    @property
+    def index(self):
+        reader = self.reader
+        return reader if reader is self.snapshot else reader.index
+
+    def publish(self):
+        # Writes the snapshot of the changes saved to the SQLite store, mapped by every worker on its next request
+        count = write(self.store.path, self.path)
+        self._load()
+        self.dirty = False
+        self.store.drop_index()  # only the snapshot is read from now on
+        print(f"Published the metadata snapshot of {count} artworks.")
+
+    def warm(self):
+        # Writes the snapshot if there's none yet, or if the SQLite store was changed without publishing it
+        # (interrupted refresh, or the store was used before)
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.version != self.store.version:
+            self.publish()
+
+    def validate(self):
+        return self.store.validate()
+
+    def sync(self):
+        changed = self.store.sync()
+        if self._load():
+            for listener in self.remote_listeners:
+                listener(None)
+            return True
+        return changed
+
+    def save(self):
+        self.store.save()
+
+    def __setitem__(self, aid, meta):
+        self.dirty = True
+        self.store[aid] = meta
+
+    def pop(self, aid, *default):
+        self.dirty = True
+        return self.store.pop(aid, *default)
+
+    def __getitem__(self, aid):
+        meta = self.get(aid)
+        if meta is None:
+            raise KeyError(aid)
+        return meta
+
+    def __contains__(self, aid):
+        return aid in self.reader
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, aid, default=None):
+        return self.reader.get(aid, default)
+
+    def keys(self):
+        return self.reader.keys()
+
+    def values(self):
+        return self.reader.values()
+
+    def items(self):
+        return self.reader.items()
+
+    def ids(self, limit=0, offset=0, sfw=False, order="default"):
+        return self.reader.ids(limit, offset, sfw, order)
+
+    def count(self, sfw=False):
+        return self.reader.count(sfw)
+
+    def group_ids(self, kind, key, limit=0, offset=0, sfw=False):
+        return self.reader.group_ids(kind, key, limit, offset, sfw)
+
+    def group_count(self, kind, key, sfw=False):
+        return self.reader.group_count(kind, key, sfw)
+
+    def top(self, kind, limit=0, sfw=False):
+        return self.reader.top(kind, limit, sfw)
+
+
+if __name__ == '__main__':
+    # Usage: python snapshot.py <artworks.db> <artworks.snap>
+    _src = sys.argv[1] if len(sys.argv) > 1 else "artworks.db"
+    _dest = sys.argv[2] if len(sys.argv) > 2 else "artworks.snap"
+    print(f"Wrote the snapshot of {write(_src, _dest)} artworks to {_dest}.")
@@ -0,0 +1,28 @@
+from utils import conf
+from disk_cache import DiskCache
+
+from .base import Storage
+from .local import LocalStorage
+
+
+def get_backend(kind, options):
+    # Remote backends keep recently proxied images in a local read-through cache
+    cache_size = conf.get("cache", {}).get("remote", 512 * 1024 ** 2)
+    shared = {"workers": options.get("workers", 8),
+              "cache": DiskCache(f"{conf.get('cache', {}).get('path', './cache')}/remote", cache_size)
+              if cache_size and kind != "local" else None,
+              "cache_qualities": conf.get("cache", {}).get("remote_qualities", ["large", "medium", "square_medium"])}
+    if kind == "local":
+        return LocalStorage(options["path"], **shared)
+    elif kind == "remote":
+        from .remote import RemoteStorage  # requests is only imported for remote storage
+        return RemoteStorage(options["server"], options["token"], proxy=options.get("proxy", False), **shared)
+    elif kind == "s3":
+        from .s3 import S3Storage
+        return S3Storage(options["bucket"], endpoint=options.get("endpoint"), access_key=options.get("access_key"),
+                         secret_key=options.get("secret_key"), region=options.get("region"),
+                         proxy=options.get("proxy", False), **shared)
+    raise ValueError(f"Unknown filesystem: {kind}")
+
+
+backend = get_backend(conf["filesystem"], conf["filesystem_options"])
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+class CachingReader:
+    # File-like wrapper around an upstream body, writing what is read to a cache file.
+    # The file is only added to the cache once the whole body was read.
+    def __init__(self, raw, size, cache, key):
+        self.raw = raw
+        self.size = size
+        self.cache = cache
+        self.key = key
+        self.tmp = cache.tmp_path(key)
+        self.f = self.tmp.open("wb")
+        self.read_size = 0
+        self.done = False
+
+    def read(self, n=-1):
+        # urllib3 reads until the connection is closed with -1, which never happens with keep-alive connections
+        data = self.raw.read(n if n is not None and n >= 0 else None)
+        if self.done:
+            return data
+        self.f.write(data)
+        self.read_size += len(data)
+        if not data or n is None or n < 0 or (self.size is not None and self.read_size >= self.size):
+            self._finish()
+        return data
+
+    def _finish(self):
+        # Called once the whole body was read, which may happen before the reader is closed
+        self.done = True
+        self.f.close()
+        if self.size is None or self.read_size == self.size:
+            self.cache.put(self.key, self.tmp)
+
+    def close(self):
+        self.raw.close()
+        if not self.done:
+            self.f.close()
+        self.tmp.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Storage:
+    # Storage backends store image files under a path (the artwork id) and a filename.
+    # Subclasses implement upload, delete and _open, and can override the bulk operations.
+    redirect = False  # whether clients can be redirected to url() instead of proxying images
+    kind = None  # name of the backend in metrics
+
+    def __init__(self, workers=8, cache=None, cache_qualities=()):
+        self.workers = workers
+        self.cache = cache
+        self.cache_qualities = cache_qualities
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="storage")
+        return self._pool
+
+    def upload(self, path, filename, source):
+        # Returns whether the file was stored
+        raise NotImplementedError
+
+    def delete(self, path, filename):
+        raise NotImplementedError
+
+    def _open(self, path, filename):
+        # Returns a readable file-like object and its size (None if unknown), raises FileNotFoundError
+        raise NotImplementedError
+
+    def stat(self, path, filename):
+        # Size of the stored file (None if unknown), raises FileNotFoundError. Backends override this with a request
+        # that doesn't transfer the file
+        raw, size = self._open(path, filename)
+        raw.close()
+        return size
+
+    def _observe(self, operation, start, size=0):
+        metrics.storage_latency.observe(time.perf_counter() - start, self.kind, operation)
+        if size:
+            metrics.storage_bytes.inc(size, self.kind, operation)
+
+    def digest(self, path, filename, chunk_size=1024 ** 2):
+        # Size and sha256 of the stored file, read from the backend and not from the cache
+        start = time.perf_counter()
+        raw, _ = self._open(path, filename)
+        h = hashlib.sha256()
+        size = 0
+        with raw:
+            while chunk := raw.read(chunk_size):
+                h.update(chunk)
+                size += len(chunk)
+        self._observe("read", start, size)
+        return size, h.hexdigest()
+
+    def local_path(self, path, filename):
+        # Path of the file on the local filesystem, for backends where it exists
+        return None
+
+    def url(self, path, filename):
+        return None
+
+    def upload_many(self, items):
+        # items are (path, filename, source) tuples, uploaded concurrently. Returns a list of results
+        return list(self.pool.map(lambda i: self._upload(*i), items))
+
+    def _upload(self, path, filename, source):
+        start = time.perf_counter()
+        ok = self.upload(path, filename, source)
+        self._observe("write", start, os.path.getsize(source) if ok else 0)
+        return ok
+
+    def delete_many(self, items):
+        # items are (path, filename) tuples, deleted concurrently
+        return list(self.pool.map(lambda i: self._delete(*i), items))
+
+    def _delete(self, path, filename):
+        start = time.perf_counter()
+        ok = self.delete(path, filename)
+        self._observe("delete", start)
+        return ok
+
+    def open(self, path, filename, quality=None):
+        # Returns a readable file-like object with a size attribute (None if unknown), served from the local cache
+        # if possible. Otherwise, the body is streamed, and cached while it is read for cached qualities
+        key = f"{path}_{filename}"
+        cached_quality = self.cache is not None and quality in self.cache_qualities
+        if cached_quality:
+            cached = self.cache.get(key)
+            if cached is not None:
+                f = cached.open("rb")
+                f.size = cached.stat().st_size
+                return f
+        start = time.perf_counter()
+        raw, size = self._open(path, filename)
+        self._observe("read", start, size or 0)  # time to the first byte, the body is streamed by the caller
+        if cached_quality:
+            return CachingReader(raw, size, self.cache, key)
+        raw.size = size
+        return raw
+
+    def invalidate(self, path, filename):
+        if self.cache is not None:
+            self.cache.invalidate(f"{path}_{filename}")
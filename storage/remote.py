@@ -0,0 +1,57 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+from .base import Storage
+
+
+class RemoteStorage(Storage):
+    # Client for php-fs (https://github.com/Proxymiity/php-fs), sharing keep-alive connections between requests.
+    # php-fs has no bulk endpoints, bulk operations are sent concurrently over the pooled connections
+    kind = "remote"
+
+    def __init__(self, server, token, proxy=False, timeout=30, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+        self.token = token
+        self.redirect = not proxy
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.workers, 16))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path, filename):
+        return f"{self.server}/{path}/{filename}"
+
+    def _open(self, path, filename):
+        r = self.session.get(self.url(path, filename), stream=True, timeout=self.timeout)
+        if not r.ok:
+            r.close()
+            raise FileNotFoundError(self.url(path, filename))
+        r.raw.decode_content = True
+        return r.raw, int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+
+    def stat(self, path, filename):
+        r = self.session.head(self.url(path, filename), timeout=self.timeout)
+        if r.status_code == 404:
+            raise FileNotFoundError(self.url(path, filename))
+        r.raise_for_status()
+        return int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+
+    def upload(self, path, filename, source):
+        with open(source, "rb") as s:
+            r = self.session.post(f"{self.server}/upload", headers={"Token": self.token},
+                                  data={"path": path, "file": filename}, files={"file": s}, timeout=self.timeout)
+        print(f"upload: {path}/{filename} - {int(r.elapsed.total_seconds() * 1000)}ms {r.status_code}")
+        if not r.ok:
+            print(f"Upload failure for {path}/{filename}.")
+        return r.ok
+
+    def delete(self, path, filename):
+        self.invalidate(path, filename)
+        r = self.session.post(f"{self.server}/delete", headers={"Token": self.token},
+                              data={"path": path, "file": filename}, timeout=self.timeout)
+        print(f"delete: {path}/{filename} - {int(r.elapsed.total_seconds() * 1000)}ms {r.status_code}")
+        if not r.ok:
+            print(f"Delete failure for {path}/{filename}.")
+        return r.ok
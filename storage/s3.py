@@ -0,0 +1,73 @@
+import time
+
+from .base import Storage
+
+
+class S3Storage(Storage):
+    # Any S3-compatible object storage (AWS, MinIO, ...). Requires boto3, which isn't installed by default
+    kind = "s3"
+
+    def __init__(self, bucket, endpoint=None, access_key=None, secret_key=None, region=None, proxy=False,
+                 client=None, **kwargs):
+        # client is a boto3 S3 client (or a stand-in with the same methods), created from the options if None
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.redirect = not proxy
+        if client is None:
+            import boto3
+            from botocore.config import Config
+            client = boto3.client("s3", endpoint_url=endpoint or None, aws_access_key_id=access_key or None,
+                                  aws_secret_access_key=secret_key or None, region_name=region or None,
+                                  config=Config(max_pool_connections=max(self.workers, 10)))
+        self.client = client
+        self.errors = self.client.exceptions
+
+    @staticmethod
+    def key(path, filename):
+        return f"{path}/{filename}"
+
+    def url(self, path, filename):
+        return self.client.generate_presigned_url("get_object", ExpiresIn=3600,
+                                                  Params={"Bucket": self.bucket, "Key": self.key(path, filename)})
+
+    def _open(self, path, filename):
+        try:
+            r = self.client.get_object(Bucket=self.bucket, Key=self.key(path, filename))
+        except self.errors.NoSuchKey:
+            raise FileNotFoundError(self.key(path, filename))
+        return r["Body"], r["ContentLength"]
+
+    def stat(self, path, filename):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(path, filename))["ContentLength"]
+        except self.errors.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise FileNotFoundError(self.key(path, filename))
+            raise
+
+    def upload(self, path, filename, source):
+        self.client.upload_file(str(source), self.bucket, self.key(path, filename))
+        print(f"upload: {path}/{filename}")
+        return True
+
+    def delete(self, path, filename):
+        return self.delete_many([(path, filename)])[0]
+
+    def delete_many(self, items):
+        # DeleteObjects removes up to 1000 keys per request
+        results = []
+        for n in range(0, len(items), 1000):
+            batch = items[n:n + 1000]
+            for i in batch:
+                self.invalidate(*i)
+            start = time.perf_counter()
+            r = self.client.delete_objects(Bucket=self.bucket, Delete={
+                "Objects": [{"Key": self.key(*i)} for i in batch], "Quiet": True})
+            self._observe("delete", start)
+            failed = {e["Key"] for e in r.get("Errors", [])}
+            for i in batch:
+                print(f"delete: {self.key(*i)}")
+                if self.key(*i) in failed:
+                    print(f"Delete failure for {self.key(*i)}.")
+            results += [self.key(*i) not in failed for i in batch]
+        return results
@@ -0,0 +1,576 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from bisect import insort, bisect_left
+from datetime import datetime
+from json import dumps, loads, load
+from pathlib import Path
+
+from shared import AtomicJSONDict
+
+SCHEMA_VERSION = 4
+# Number of changes kept in the change log, a worker more changes behind reloads its whole index
+CHANGE_LOG_SIZE = 10000
+
+
+def parse_date(create_date):
+    # pixiv dates are ISO-8601 with an offset, stored as a unix timestamp so they can be sorted across offsets
+    return int(datetime.strptime(create_date, "%Y-%m-%dT%H:%M:%S%z").timestamp())
+
+
+class ArtworkIndex:
+    # In-memory ordered views of the store, so pages can be sliced without reading every artwork.
+    # Every list is sorted in ascending order, pages are read from the end to get the newest artworks first.
+    def __init__(self):
+        self.entries = {}  # id -> (seq, create_date, sfw, user id, tags)
+        self.by_seq = []  # (seq, id)
+        self.by_seq_sfw = []
+        self.by_date = []  # (create_date, seq, id)
+        self.by_date_sfw = []
+        # Inverted maps of the artworks of every tag and user, as lists of seqs (shared with entries)
+        self.seq_ids = {}  # seq -> id
+        self.groups = {"tag": {}, "user": {}}
+        self.groups_sfw = {"tag": {}, "user": {}}
+        self._top = {}  # rankings of the groups by size, cleared on every change
+
+    def _group_keys(self, entry):
+        seq, _, sfw, user, tags = entry
+        keys = [("tag", t) for t in tags] + ([("user", user)] if user is not None else [])
+        return [(self.groups, k) for k in keys] + ([(self.groups_sfw, k) for k in keys] if sfw else [])
+
+    @classmethod
+    def build(cls, rows):
+        # Index of (id, seq, create_date, sfw, user id, tags) rows with unique ids. Every list is sorted once, add() is
+        # meant for incremental changes
+        index = cls()
+        for aid, seq, create_date, sfw, user, tags in rows:
+            entry = index.entries[aid] = (seq, create_date, sfw, user, tuple(sorted(set(tags))))
+            index.seq_ids[seq] = aid
+            index.by_seq.append((seq, aid))
+            index.by_date.append((create_date, seq, aid))
+            if sfw:
+                index.by_seq_sfw.append((seq, aid))
+                index.by_date_sfw.append((create_date, seq, aid))
+            for groups, (kind, key) in index._group_keys(entry):
+                groups[kind].setdefault(key, []).append(seq)
+        for lst in (index.by_seq, index.by_date, index.by_seq_sfw, index.by_date_sfw):
+            lst.sort()
+        for groups in (index.groups, index.groups_sfw):
+            for lists in groups.values():
+                for lst in lists.values():
+                    lst.sort()
+        return index
+
+    def add(self, aid, seq, create_date, sfw, user=None, tags=()):
+        entry = (seq, create_date, sfw, user, tuple(sorted(set(tags))))
+        if aid in self.entries:
+            if self.entries[aid] == entry:
+                return
+            self.remove(aid)
+        self.entries[aid] = entry
+        self.seq_ids[seq] = aid
+        insort(self.by_seq, (seq, aid))
+        insort(self.by_date, (create_date, seq, aid))
+        if sfw:
+            insort(self.by_seq_sfw, (seq, aid))
+            insort(self.by_date_sfw, (create_date, seq, aid))
+        for groups, (kind, key) in self._group_keys(entry):
+            insort(groups[kind].setdefault(key, []), seq)
+        self._top.clear()
+
+    def remove(self, aid):
+        if aid not in self.entries:
+            return
+        entry = self.entries.pop(aid)
+        seq, create_date, sfw, _, _ = entry
+        del self.seq_ids[seq]
+        lists = [(self.by_seq, (seq, aid)), (self.by_date, (create_date, seq, aid))]
+        if sfw:
+            lists += [(self.by_seq_sfw, (seq, aid)), (self.by_date_sfw, (create_date, seq, aid))]
+        for lst, key in lists:
+            del lst[bisect_left(lst, key)]
+        for groups, (kind, key) in self._group_keys(entry):
+            lst = groups[kind][key]
+            del lst[bisect_left(lst, seq)]
+            if not lst:
+                del groups[kind][key]
+        self._top.clear()
+
+    @staticmethod
+    def _page(lst, limit, offset):
+        end = max(len(lst) - offset, 0)
+        start = max(end - limit, 0) if limit else 0
+        return reversed(lst[start:end])
+
+    def count(self, sfw=False):
+        return len(self.by_seq_sfw) if sfw else len(self.entries)
+
+    def ids(self, limit=0, offset=0, sfw=False, order="default"):
+        if order == "artwork":
+            lst = self.by_date_sfw if sfw else self.by_date
+        else:
+            lst = self.by_seq_sfw if sfw else self.by_seq
+        return [e[-1] for e in self._page(lst, limit, offset)]
+
+    def last_seq(self):
+        return self.by_seq[-1][0] if self.by_seq else None
+
+    def group_count(self, kind, key, sfw=False):
+        return len((self.groups_sfw if sfw else self.groups)[kind].get(key, ()))
+
+    def group_ids(self, kind, key, limit=0, offset=0, sfw=False):
+        # Newest bookmarks first, of the artworks with the tag (kind = tag) or by the user (kind = user)
+        lst = (self.groups_sfw if sfw else self.groups)[kind].get(key, [])
+        return [self.seq_ids[seq] for seq in self._page(lst, limit, offset)]
+
+    def top(self, kind, limit=0, sfw=False):
+        # (key, count) of the largest groups. The ranking is only sorted again after the index changed
+        if (kind, sfw) not in self._top:
+            groups = (self.groups_sfw if sfw else self.groups)[kind]
+            self._top[(kind, sfw)] = sorted(((k, len(v)) for k, v in groups.items()), key=lambda g: (-g[1], str(g[0])))
+        ranking = self._top[(kind, sfw)]
+        return ranking[:limit] if limit else ranking
+
+
+class SQLiteStore:
+    # Artwork metadata store backed by SQLite. Keys are exposed as strings to stay compatible with the JSON store,
+    # and the bookmark (ingress) order is kept by the auto-incremented seq column, which is never updated.
+    # Every write is also appended to the changes table, so the other worker processes sharing the database can
+    # bring their in-memory index up to date with sync() instead of reading the whole table again.
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self._index = None
+        self._warming = None  # set once the index being built by warm() is ready
+        self._rebuilding = False  # whether the index is being built again in the background by sync()
+        self.listeners = []  # called with the artwork id every time an artwork is changed or removed
+        # Called by sync() with the id of every artwork changed by another process, or with None if any artwork may
+        # have changed. Shared indexes (search, hashes) were already updated by that process, only caches are cleared
+        self.remote_listeners = []
+        self.save_listeners = []  # called by save() once the changes are committed
+        self.own = set()  # versions of the changes made by this process, already applied to its index
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock:
+            # Readers of other processes aren't blocked by the (long) refresh transaction
+            self.db.execute("PRAGMA journal_mode = WAL")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:  # opening an up-to-date database doesn't write to it
+                self._upgrade(version)
+            self.version = self._last_version()
+            self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _upgrade(self, version):
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS artworks (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id INTEGER NOT NULL UNIQUE,
+                    x_restrict INTEGER NOT NULL,
+                    create_date INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    meta TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS artworks_x_restrict ON artworks (x_restrict, seq);
+                CREATE INDEX IF NOT EXISTS artworks_create_date ON artworks (create_date);
+                CREATE INDEX IF NOT EXISTS artworks_user_id ON artworks (user_id);
+                CREATE TABLE IF NOT EXISTS artwork_tags (
+                    id INTEGER NOT NULL,
+                    name TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS artwork_tags_id ON artwork_tags (id);
+                CREATE INDEX IF NOT EXISTS artwork_tags_name ON artwork_tags (name);
+                CREATE TABLE IF NOT EXISTS changes (
+                    version INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            if version == 1:  # artwork_tags was added in version 2
+                for aid, meta in self.db.execute("SELECT id, meta FROM artworks").fetchall():
+                    self._set_tags(aid, loads(meta))
+            if 0 < version < 4 and self.db.execute("SELECT 1 FROM artworks LIMIT 1").fetchone():
+                # Databases created before version 4 were filled by the JSON migration in a single transaction
+                self.db.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('migrated', '')")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.db.commit()
+
+    def migrated(self):
+        # Whether the legacy JSON file was imported, the marker being committed with the imported artworks
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM state WHERE key = 'migrated'").fetchone() is not None
+
+    def _last_version(self):
+        return self.db.execute("SELECT COALESCE(MAX(version), 0) FROM changes").fetchone()[0]
+
+    def _log(self, aid):
+        self.own.add(self.db.execute("INSERT INTO changes (id) VALUES (?)", (aid,)).lastrowid)
+
+    @staticmethod
+    def _key(aid):
+        try:
+            return int(aid)
+        except (TypeError, ValueError):
+            return None
+
+    def _set_tags(self, aid, meta):
+        self.db.execute("DELETE FROM artwork_tags WHERE id = ?", (aid,))
+        self.db.executemany("INSERT INTO artwork_tags (id, name) VALUES (?, ?)",
+                            [(aid, t) for t in {t["name"] for t in meta["tags"]}])
+
+    @staticmethod
+    def _build_index(db):
+        tags = {}
+        for aid, name in db.execute("SELECT id, name FROM artwork_tags"):
+            tags.setdefault(aid, []).append(name)
+        return ArtworkIndex.build((str(aid), seq, create_date, x_restrict <= 0, user_id, tags.get(aid, ()))
+                                  for aid, seq, create_date, x_restrict, user_id in db.execute(
+                                      "SELECT id, seq, create_date, x_restrict, user_id FROM artworks ORDER BY seq"))
+
+    @property
+    def index(self):
+        # Built on first use from the indexed columns only, then kept up to date by __setitem__ and pop
+        warming = self._warming
+        if warming is not None:
+            warming.wait()  # waiting for warm() is faster than building the index again
+        with self.lock:
+            if self._index is None:
+                self._index = self._build_index(self.db)
+            return self._index
+
+    def warm(self):
+        # Builds the index from a snapshot read by another connection, without blocking the requests in the meantime,
+        # then applies the changes committed since the snapshot
+        warming = self._warming = threading.Event()
+        try:
+            self._warm()
+        finally:
+            warming.set()
+            if self._warming is warming:
+                self._warming = None
+
+    def _rebuild(self):
+        # Replaces an index which missed pruned changes, built like warm() while the current one keeps serving
+        try:
+            self._warm(replace=True)
+        finally:
+            self._rebuilding = False
+
+    def _warm(self, replace=False):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute("BEGIN")
+            version = db.execute("SELECT COALESCE(MAX(version), 0) FROM changes").fetchone()[0]
+            index = self._build_index(db)
+        finally:
+            db.close()
+        # A thread holding the lock may be waiting for this index: it builds its own if the lock can't be acquired
+        if not self.lock.acquire(timeout=-1 if replace else 1):
+            return
+        try:
+            if self._index is not None and not replace:
+                return  # built by a request in the meantime
+            oldest = self.db.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+            if oldest is not None and oldest > version + 1:
+                if replace:
+                    self._index = None
+                return  # the changes since the snapshot were pruned, the index is built on first use instead
+            self._index = index
+            for (aid,) in self.db.execute("SELECT DISTINCT id FROM changes WHERE version > ?", (version,)).fetchall():
+                self._reindex(aid)
+        finally:
+            self.lock.release()
+
+    def drop_index(self):
+        # Frees the index, built again on next use
+        with self.lock:
+            self._index = None
+
+    @contextmanager
+    def _indexed(self):
+        # Holds the lock, with the index built (or waited for) before taking it
+        self.index
+        with self.lock:
+            yield self.index
+
+    def validate(self):
+        # Problems found by SQLite's integrity check, run on another connection so that requests aren't blocked
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            return [r[0] for r in db.execute("PRAGMA quick_check") if r[0] != "ok"]
+        finally:
+            db.close()
+
+    def __contains__(self, aid):
+        key = self._key(aid)
+        if key is None:
+            return False
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM artworks WHERE id = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, aid):
+        meta = self.get(aid)
+        if meta is None:
+            raise KeyError(aid)
+        return meta
+
+    def __setitem__(self, aid, meta):
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO artworks (id, x_restrict, create_date, user_id, meta) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET x_restrict = excluded.x_restrict, create_date = excluded.create_date,
+                                               user_id = excluded.user_id, meta = excluded.meta
+            """, (int(aid), meta["x_restrict"], parse_date(meta["create_date"]), meta["user"]["id"], dumps(meta)))
+            self._set_tags(int(aid), meta)
+            self._log(int(aid))
+            if self._index is not None:
+                seq = self.db.execute("SELECT seq FROM artworks WHERE id = ?", (int(aid),)).fetchone()[0]
+                self._index.add(str(aid), seq, parse_date(meta["create_date"]), meta["x_restrict"] <= 0,
+                                meta["user"]["id"], [t["name"] for t in meta["tags"]])
+        self._notify(aid)
+
+    def __len__(self):
+        return self.count()
+
+    def _notify(self, aid):
+        for listener in self.listeners:
+            listener(str(aid))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, aid, default=None):
+        key = self._key(aid)
+        if key is None:
+            return default
+        with self.lock:
+            row = self.db.execute("SELECT meta FROM artworks WHERE id = ?", (key,)).fetchone()
+        return loads(row[0]) if row else default
+
+    def pop(self, aid, *default):
+        meta = self.get(aid)
+        if meta is None:
+            if default:
+                return default[0]
+            raise KeyError(aid)
+        with self.lock:
+            self.db.execute("DELETE FROM artworks WHERE id = ?", (self._key(aid),))
+            self.db.execute("DELETE FROM artwork_tags WHERE id = ?", (self._key(aid),))
+            self._log(self._key(aid))
+            if self._index is not None:
+                self._index.remove(str(self._key(aid)))
+        self._notify(aid)
+        return meta
+
+    def keys(self):
+        with self.lock:
+            return [str(r[0]) for r in self.db.execute("SELECT id FROM artworks ORDER BY seq")]
+
+    def values(self):
+        with self.lock:
+            return [loads(r[0]) for r in self.db.execute("SELECT meta FROM artworks ORDER BY seq")]
+
+    def items(self):
+        with self.lock:
+            return [(str(r[0]), loads(r[1])) for r in self.db.execute("SELECT id, meta FROM artworks ORDER BY seq")]
+
+    def ids(self, limit=0, offset=0, sfw=False, order="default"):
+        # Newest bookmarks (or newest artworks if order = artwork) first, as displayed on the home page
+        with self._indexed() as index:
+            return index.ids(limit, offset, sfw, order)
+
+    def count(self, sfw=False):
+        with self._indexed() as index:
+            return index.count(sfw)
+
+    def group_ids(self, kind, key, limit=0, offset=0, sfw=False):
+        # Newest bookmarks first, of the artworks with a tag (kind = tag) or by a user id (kind = user)
+        with self._indexed() as index:
+            return index.group_ids(kind, key, limit, offset, sfw)
+
+    def group_count(self, kind, key, sfw=False):
+        with self._indexed() as index:
+            return index.group_count(kind, key, sfw)
+
+    def top(self, kind, limit=0, sfw=False):
+        # Tags or user ids with the most artworks, as (key, count)
+        with self._indexed() as index:
+            return index.top(kind, limit, sfw)
+
+    def sync(self):
+        # Applies the changes committed by other processes since the last call, and notifies the remote listeners.
+        # data_version only changes when another connection committed, so this is cheap enough to call on every request
+        with self.lock:
+            data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return False
+            self.data_version = data_version
+            oldest = self.db.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+            changes = self.db.execute("SELECT version, id FROM changes WHERE version > ? ORDER BY version",
+                                      (self.version,)).fetchall()
+            changed = []
+            pruned = oldest is not None and oldest > self.version + 1
+            if pruned:
+                # The changes we missed were pruned: the index is built again in the background, and the current one
+                # (brought up to date with the changes still logged) keeps serving requests in the meantime
+                if self._index is not None and not self._rebuilding:
+                    self._rebuilding = True
+                    threading.Thread(target=self._rebuild, name="reindex", daemon=True).start()
+                changed.append(None)
+            for version, aid in changes:
+                if version in self.own:
+                    self.own.discard(version)
+                    continue
+                if not pruned:
+                    changed.append(str(aid))
+                if self._index is not None:
+                    self._reindex(aid)
+            self.version = max(self.version, changes[-1][0] if changes else 0)
+        for aid in dict.fromkeys(changed):
+            for listener in self.remote_listeners:
+                listener(aid)
+        return bool(changed)
+
+    def _reindex(self, aid):
+        row = self.db.execute("SELECT seq, create_date, x_restrict, user_id FROM artworks WHERE id = ?",
+                              (aid,)).fetchone()
+        if row is None:
+            self._index.remove(str(aid))
+        else:
+            tags = [r[0] for r in self.db.execute("SELECT name FROM artwork_tags WHERE id = ?", (aid,))]
+            self._index.add(str(aid), row[0], row[1], row[2] <= 0, row[3], tags)
+
+    def save(self):
+        with self.lock:
+            if self.db.execute("PRAGMA data_version").fetchone()[0] == self.data_version:
+                # No other process committed since the last sync, every newer change is ours
+                self.version = self._last_version()
+                self.own.clear()
+            self.db.execute("DELETE FROM changes WHERE version <= ?", (self._last_version() - CHANGE_LOG_SIZE,))
+            self.db.commit()
+        for listener in self.save_listeners:
+            listener()
+
+    def publish(self):
+        pass  # the other processes read the saved changes with sync()
+
+
+class JSONStore(AtomicJSONDict):
+    # Legacy store, loading and rewriting the whole artworks.json file. Other processes reload it with sync()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.listeners = getattr(self, "listeners", [])  # kept across reload()
+        self.remote_listeners = getattr(self, "remote_listeners", [])
+        self.save_listeners = getattr(self, "save_listeners", [])
+        self._build_index()
+
+    def _build_index(self):
+        self.index = ArtworkIndex.build((k, seq, parse_date(v["create_date"]), v["x_restrict"] <= 0, v["user"]["id"],
+                                         [t["name"] for t in v["tags"]]) for seq, (k, v) in enumerate(self.items()))
+        self.seq = len(self.index.entries)
+
+    def _index_add(self, aid, meta):
+        # Updated artworks keep their position, like dict keys do
+        seq = self.index.entries[aid][0] if aid in self.index.entries else self.seq
+        self.seq += 1
+        self.index.add(aid, seq, parse_date(meta["create_date"]), meta["x_restrict"] <= 0, meta["user"]["id"],
+                       [t["name"] for t in meta["tags"]])
+
+    def __setitem__(self, aid, meta):
+        super().__setitem__(aid, meta)
+        self._index_add(str(aid), meta)
+        for listener in self.listeners:
+            listener(str(aid))
+
+    def pop(self, aid, *default):
+        self.index.remove(str(aid))
+        meta = super().pop(aid, *default)
+        for listener in self.listeners:
+            listener(str(aid))
+        return meta
+
+    def sync(self):
+        if not super().sync():
+            return False
+        self._build_index()
+        for listener in self.remote_listeners:
+            listener(None)
+        return True
+
+    def save(self):
+        super().save()
+        for listener in self.save_listeners:
+            listener()
+
+    def warm(self):
+        pass  # the whole file is read and indexed when it is opened
+
+    def validate(self):
+        return []  # the file was parsed already
+
+    def publish(self):
+        pass  # the other processes reload the saved file with sync()
+
+    def ids(self, limit=0, offset=0, sfw=False, order="default"):
+        return self.index.ids(limit, offset, sfw, order)
+
+    def count(self, sfw=False):
+        return self.index.count(sfw)
+
+    def group_ids(self, kind, key, limit=0, offset=0, sfw=False):
+        return self.index.group_ids(kind, key, limit, offset, sfw)
+
+    def group_count(self, kind, key, sfw=False):
+        return self.index.group_count(kind, key, sfw)
+
+    def top(self, kind, limit=0, sfw=False):
+        return self.index.top(kind, limit, sfw)
+
+
+def migrate_json(store, path, force=False):
+    # One-shot import of a legacy artworks.json, keeping the bookmark order of the file. The artworks are committed
+    # along with the migration marker, in a single transaction: an interrupted migration is started over on next start
+    with open(path, encoding="utf-8", mode="r") as f:
+        data = load(f)
+    with store.lock:
+        store.db.execute("BEGIN IMMEDIATE")  # another worker starting at the same time waits, then finds the marker
+        try:
+            if not force and store.migrated():
+                store.db.rollback()
+                return 0
+            for k, v in data.items():
+                store[k] = v
+            store.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('migrated', ?)", (str(path),))
+            store.save()
+        except BaseException:
+            store.db.rollback()
+            store.own.clear()
+            store.drop_index()
+            raise
+    print(f"Migrated {len(data)} artworks from {path} to {store.path}.")
+    return len(data)
+
+
+def open_store(kind, options):
+    if kind == "json":
+        return JSONStore(options.get("path", "artworks.json"))
+    elif kind in ("sqlite", "snapshot"):
+        store = SQLiteStore(options.get("path", "artworks.db"))
+        legacy = Path(options.get("migrate_from", "artworks.json"))
+        if legacy.is_file() and not store.migrated():
+            migrate_json(store, legacy)
+        if kind == "snapshot":
+            from snapshot import SnapshotStore
+            return SnapshotStore(store, options.get("snapshot", "artworks.snap"))
+        return store
+    raise ValueError(f"Unknown store type: {kind}")
+
+
+if __name__ == '__main__':
+    import sys
+    # Usage: python store.py <artworks.json> <artworks.db>
+    _src = sys.argv[1] if len(sys.argv) > 1 else "artworks.json"
+    _dest = sys.argv[2] if len(sys.argv) > 2 else "artworks.db"
+    migrate_json(SQLiteStore(_dest), _src, force=True)
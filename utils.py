@@ -1,49 +1,69 @@
 from flask import flash as orig_flash, Markup, request
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 
-from pxyTools import JSONDict
+from shared import AtomicJSONDict, FileLock
+from store import open_store
 
-conf = JSONDict("config.json")
-artworks = JSONDict("artworks.json")
-temp = JSONDict("temp.json")
+conf = AtomicJSONDict("config.json")
+artworks = open_store(conf.get("store", "sqlite"), conf.get("store_options", {}))
+temp = AtomicJSONDict("temp.json")
+# Held by the worker process refreshing or deleting artworks, and by the one hashing them for duplicate detection
+write_lock = FileLock(f"{conf['temp_path']}/write.lock")
+hash_lock = FileLock(f"{conf['temp_path']}/hash.lock")
 
 
 def flash(message, category):
     return orig_flash(Markup(message), category)
 
 
-def update_metadata(aws):
+# pixiv replaces the images of deleted or restricted artworks with these placeholders
+LIMIT_IMAGES = ("limit_unknown_360", "limit_mypixiv_360")
+
+
+def is_limited(aw):
+    urls = list(aw["image_urls"].values())
+    if aw["meta_single_page"]:
+        urls += aw["meta_single_page"].values()
+    return any(x in u for u in urls for x in LIMIT_IMAGES)
+
+
+def classify_bookmarks(aws):
+    # Single pass over the bookmarks, returning the stored artworks whose metadata can be updated
+    # and the new artworks to download
+    known = set(artworks.ids())
+    update, new = [], []
     for aw in aws:
-        # Passes if artwork isn't stored, has limit flags or restrict other than zero
-        if str(aw["id"]) not in artworks:
-            print(f"Metadata not found on disk for Artwork {aw['id']}")
-            continue
-        if any(x in str(aw) for x in ("limit_unknown_360", "limit_mypixiv_360")):
+        stored = str(aw["id"]) in known
+        # Passes if artwork has limit flags or restrict other than zero
+        if is_limited(aw):
             print(f"Avoided possible pixiv deletion for Artwork {aw['id']} (has limit)")
             continue
         if aw["restrict"] != 0:
             print(f"Avoided possible pixiv deletion for Artwork {aw['id']} (restrict != 0)")
             continue
-        # Update metadata for artwork
-        artworks[str(aw["id"])] = aw
+        if stored:
+            update.append(aw)
+        # Passes if artwork is animated (video/gif)
+        elif aw["type"] == "ugoira":
+            print(f"Not adding unsupported pixiv Artwork {aw['id']} (ugoira)")
+        else:
+            new.append(aw)
+    return update, new
 
 
-def filter_artworks(aws):
-    new = []
-    for i in aws:
-        # Passes if artwork has limit flags, restrict other than zero or is animated (video/gif)
-        if any(x in str(i) for x in ("limit_unknown_360", "limit_mypixiv_360")):
-            print(f"Not adding possible deleted pixiv Artwork {i['id']} (has limit)")
-            continue
-        if i["restrict"] != 0:
-            print(f"Not adding possible deleted pixiv Artwork {i['id']} (restrict != 0)")
-            continue
-        if "ugoira" in str(i):
-            print(f"Not adding unsupported pixiv Artwork {i['id']} (ugoira)")
+def update_metadata(aws):
+    # aws are the stored artworks returned by classify_bookmarks. Returns the ids of the artworks whose pages changed
+    # Unchanged artworks aren't written: every write goes to the change log read by the other workers
+    changed = []
+    for aw in aws:
+        old = artworks.get(str(aw["id"]))
+        if old == aw:
             continue
-        if str(i["id"]) not in artworks:
-            new.append(i)
-    return new
+        if old and (old["meta_pages"], old["meta_single_page"]) != (aw["meta_pages"], aw["meta_single_page"]):
+            changed.append(aw["id"])
+        # Update metadata for artwork
+        artworks[str(aw["id"])] = aw
+    return changed
 
 
 def gen_paginate_data(current, pages, base_path, margin=2,
@@ -87,10 +107,8 @@ def gen_paginate_data(current, pages, base_path, margin=2,
 
 
 def now_tz():
-    # Determines the UTC offset based on local time
-    offset = round((datetime.now() - datetime.utcnow()).seconds/3600)
-    tzdata = timezone(timedelta(hours=offset))
-    return datetime.now(tzdata)
+    # Local time, aware of the local UTC offset
+    return datetime.now(timezone.utc).astimezone()
 
 
 def get_nsfw(page):